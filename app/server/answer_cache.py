@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import uuid
+import numpy as np
+import redis
+from embedding_model import EMBED_MODEL_ID
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+# Minimum cosine similarity between query embeddings to reuse an answer
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_MAX_PER_SCOPE = int(os.getenv("ANSWER_CACHE_MAX_PER_SCOPE", "200"))
+
+# Vectors from another model or backend are not comparable, so each gets
+# its own key space (switching EMBED_BACKEND starts from an empty cache)
+_KEY_PREFIX = f"answer_cache:{EMBED_MODEL_ID}"
+_redis = None
+
+def _client():
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+    return _redis
+
+def _scope_key(collection_name, mode):
+    return f"{_KEY_PREFIX}:{collection_name}:{(mode or 'discrete').lower()}"
+
+# A scope is two keys: "<scope>:vectors", a list of entry id + raw float32
+# query vector (newest first), and "<scope>:answers", a hash of entry id ->
+# answer JSON. Lookups only pull the vectors and HGET the one answer hit.
+_ID_LEN = 32
+
+def _vectors_key(scope_key):
+    return f"{scope_key}:vectors"
+
+def _answers_key(scope_key):
+    return f"{scope_key}:answers"
+
+def _normalize(vec):
+    arr = np.asarray(vec, dtype=np.float32)
+    return arr / (np.linalg.norm(arr) or 1.0)
+
+def lookup(collection_name, mode, query_embedding):
+    """
+    Returns {"answer", "sources", "similarity"} for the most similar cached
+    question in this collection/mode scope, or None below the threshold.
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    key = _scope_key(collection_name, mode)
+    try:
+        raw = _client().lrange(_vectors_key(key), 0, -1)
+    except redis.RedisError as e:
+        print(f"DEBUG: Answer cache lookup failed: {e}")
+        return None
+    if not raw:
+        return None
+
+    try:
+        matrix = np.frombuffer(b"".join(r[_ID_LEN:] for r in raw), dtype=np.float32)
+        sims = matrix.reshape(len(raw), -1) @ _normalize(query_embedding)
+    except ValueError as e:
+        print(f"DEBUG: Ignoring unreadable answer cache for '{collection_name}': {e}")
+        return None
+    best = int(np.argmax(sims))
+    if sims[best] < ANSWER_CACHE_THRESHOLD:
+        return None
+    try:
+        payload = _client().hget(_answers_key(key), raw[best][:_ID_LEN])
+    except redis.RedisError as e:
+        print(f"DEBUG: Answer cache lookup failed: {e}")
+        return None
+    if payload is None:
+        # Trimmed or invalidated between the two reads
+        return None
+    hit = json.loads(payload)
+    return {"answer": hit["answer"], "sources": hit["sources"], "similarity": float(sims[best])}
+
+def _user_keys(user_id):
+    """Set of every scope key written for a user, so invalidation never has to SCAN."""
+    return f"{_KEY_PREFIX}:keys:user_{user_id}"
+
+def store(collection_name, mode, query, query_embedding, answer, sources, user_id):
+    if not ANSWER_CACHE_ENABLED or not answer:
+        return
+    entry_id = uuid.uuid4().hex.encode("ascii")
+    payload = json.dumps({"query": query, "answer": answer, "sources": sources, "created_at": time.time()})
+    key = _scope_key(collection_name, mode)
+    vectors, answers, registry = _vectors_key(key), _answers_key(key), _user_keys(user_id)
+    try:
+        client = _client()
+        # Entries this push will trim off the end; their answers go too
+        trimmed = client.lrange(vectors, ANSWER_CACHE_MAX_PER_SCOPE - 1, -1)
+        pipe = client.pipeline()
+        pipe.lpush(vectors, entry_id + _normalize(query_embedding).tobytes())
+        pipe.ltrim(vectors, 0, ANSWER_CACHE_MAX_PER_SCOPE - 1)
+        pipe.hset(answers, entry_id, payload)
+        if trimmed:
+            pipe.hdel(answers, *[r[:_ID_LEN] for r in trimmed])
+        for k in (vectors, answers):
+            pipe.expire(k, ANSWER_CACHE_TTL)
+        pipe.sadd(registry, vectors, answers)
+        pipe.expire(registry, ANSWER_CACHE_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f"DEBUG: Answer cache store failed: {e}")
+
+def document_scope(user_id, filename):
+    return f"user_{user_id}__{filename}"
+
+def multi_scope(user_id, collection_ids):
+    """Scope for questions asked across several of a user's documents."""
+    return f"user_{user_id}__multi__{'-'.join(str(i) for i in sorted(collection_ids))}"
+
+def invalidate_document(user_id, filename):
+    """Drops answers for one document and every cross-document scope of its owner."""
+    prefixes = (
+        f"{_KEY_PREFIX}:{document_scope(user_id, filename)}:",
+        f"{_KEY_PREFIX}:user_{user_id}__multi__",
+    )
+    try:
+        client = _client()
+        registry = _user_keys(user_id)
+        # Reads only this user's registry; a member whose key already
+        # expired is harmless to delete
+        keys = [k for k in client.smembers(registry) if k.decode("utf-8").startswith(prefixes)]
+        if keys:
+            pipe = client.pipeline()
+            pipe.delete(*keys)
+            pipe.srem(registry, *keys)
+            pipe.execute()
+    except redis.RedisError as e:
+        print(f"DEBUG: Answer cache invalidation failed: {e}")
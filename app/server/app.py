@@ -1,20 +1,33 @@
 import os
+import json
+import time
+import hashlib
 from dotenv import load_dotenv
 load_dotenv()
 
-from flask import Flask, request, jsonify, session, send_file
+from flask import Flask, Response, request, jsonify, session, send_file
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
-from database import get_conn, init_db
+from database import get_conn, init_db, pool_stats
 
 from models import (
     create_user, verify_user, find_user_by_id,
     create_collection_entry, list_collections_for_user, find_collection_by_id,
-    create_chat, list_chats_for_user, get_recent_memories, add_memory
+    get_collection_file, forget_collection_file,
+    create_chat, list_chats_for_user, get_memories_page, add_memory
 )
-from tasks import process_pdf_task
+from tasks import process_pdf_task, clone_collection_task
 from rag import run_agent
+from embedding_manager import (
+    delete_collection as delete_chroma_collection, delete_documents, legacy_collection_name, get_query_embedding,
+    query_cache
+)
+from web_search import search_cache
+from llm import ALL_MODELS_FAILED
+import answer_cache
+import metrics
+import page_store
 
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET", "prod-secret-key")
@@ -22,8 +35,10 @@ app.secret_key = os.getenv("FLASK_SECRET", "prod-secret-key")
 CORS(app,
      supports_credentials=True,
      origins=["http://localhost:3000"],
-     methods=["GET", "POST", "DELETE", "OPTIONS"],
-     allow_headers=["Content-Type", "Authorization"]
+     methods=["GET", "HEAD", "POST", "DELETE", "OPTIONS"],
+     allow_headers=["Content-Type", "Authorization", "Range", "If-None-Match", "If-Modified-Since", "If-Range"],
+     # Lets a cross-origin PDF viewer read range responses and validators
+     expose_headers=["Accept-Ranges", "Content-Range", "Content-Length", "ETag", "Last-Modified"]
 )
 
 UPLOAD_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "uploads")
@@ -36,7 +51,25 @@ except Exception as e:
 
 @app.route("/api/health", methods=["GET"])
 def health():
-    return jsonify({"status": "healthy", "db": "postgres", "worker": "celery"})
+    return jsonify({"status": "healthy", "db": "postgres", "worker": "celery", "db_pool": pool_stats()})
+
+
+def _cache_gauges(name, description, stats):
+    # In-process caches: the values belong to whichever worker answered
+    labels = {"pid": os.getpid()}
+    return [
+        (f"{name}_{stat}", f"{description}: {stat.replace('_', ' ')} in the serving process", labels, value)
+        for stat, value in stats.items()
+    ]
+
+
+@app.route("/api/metrics", methods=["GET"])
+def metrics_route():
+    # The chunk embedding cache is only used by ingest workers; its hit and
+    # miss counters reach this endpoint through metrics.incr instead
+    gauges = _cache_gauges("query_embedding_cache", "Query embedding LRU", query_cache.stats())
+    gauges += _cache_gauges("web_search_cache", "Serper result cache", search_cache.stats())
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/api/register", methods=["POST"])
@@ -49,20 +82,20 @@ def register():
     if not username or not password:
         return jsonify({"ok": False, "error": "Missing fields"}), 400
 
-    conn = get_conn()
-    cur = conn.cursor()
     try:
-        cur.execute("SELECT id FROM users WHERE username = %s", (username,))
-        if cur.fetchone():
-            return jsonify({"ok": False, "error": "Username taken"}), 409
-
-        pw_hash = generate_password_hash(password)
-        cur.execute(
-            "INSERT INTO users (username, email, password_hash) VALUES (%s, %s, %s) RETURNING id",
-            (username, email, pw_hash)
-        )
-        uid = cur.fetchone()['id']
-        conn.commit()
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT id FROM users WHERE username = %s", (username,))
+            if cur.fetchone():
+                return jsonify({"ok": False, "error": "Username taken"}), 409
+
+            pw_hash = generate_password_hash(password)
+            cur.execute(
+                "INSERT INTO users (username, email, password_hash) VALUES (%s, %s, %s) RETURNING id",
+                (username, email, pw_hash)
+            )
+            uid = cur.fetchone()['id']
+            conn.commit()
         
         session["user_id"] = uid
         resp = jsonify({"ok": True, "user": {"id": uid, "username": username}})
@@ -70,8 +103,6 @@ def register():
         return resp
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
-    finally:
-        conn.close()
 
 @app.route("/api/login", methods=["POST"])
 def login():
@@ -79,11 +110,10 @@ def login():
     username = data.get("username")
     password = data.get("password")
 
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE username = %s", (username,))
-    user = cur.fetchone()
-    conn.close()
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM users WHERE username = %s", (username,))
+        user = cur.fetchone()
 
     if user and check_password_hash(user['password_hash'], password):
         session["user_id"] = user['id']
@@ -98,11 +128,10 @@ def me():
     uid = session.get("user_id")
     if not uid: return jsonify({"ok": False})
     
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, username, email FROM users WHERE id = %s", (uid,))
-    user = cur.fetchone()
-    conn.close()
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, username, email FROM users WHERE id = %s", (uid,))
+        user = cur.fetchone()
     return jsonify({"ok": True, "user": dict(user)}) if user else jsonify({"ok": False})
 
 @app.route("/api/logout", methods=["POST"])
@@ -126,35 +155,89 @@ def upload_pdf():
     user_dir = os.path.join(UPLOAD_ROOT, str(user_id))
     os.makedirs(user_dir, exist_ok=True)
     stored_path = os.path.join(user_dir, filename)
-    f.save(stored_path)
-
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO collections (user_id, filename, stored_path, processing_status) VALUES (%s, %s, %s, 'pending') RETURNING id",
-        (user_id, filename, stored_path)
-    )
-    cid = cur.fetchone()['id']
-    conn.commit()
-    conn.close()
+    tmp_path, content_hash = _save_and_hash(f, stored_path)
 
-    process_pdf_task.delay(stored_path, filename, user_id, cid)
-
-    return jsonify({"ok": True, "collection_id": cid, "status": "processing"})
+    try:
+        with get_conn() as conn:
+            cur = conn.cursor()
+            # The newest row for this name owns the file on disk. Only when it
+            # already holds these bytes is the upload a no-op; an older row
+            # with the same hash was overwritten by a later revision.
+            cur.execute(
+                """SELECT id, content_hash, processing_status FROM collections
+                   WHERE user_id = %s AND filename = %s
+                   ORDER BY id DESC LIMIT 1""",
+                (user_id, filename)
+            )
+            live = cur.fetchone()
+            if live and live['content_hash'] == content_hash and live['processing_status'] == 'completed':
+                return jsonify({"ok": True, "collection_id": live['id'], "status": "completed", "deduplicated": True})
+
+            # Prefer the uploader's own copy, then any other completed copy
+            cur.execute(
+                """SELECT id, user_id, filename FROM collections
+                   WHERE content_hash = %s AND processing_status = 'completed'
+                   ORDER BY (user_id = %s) DESC, id DESC LIMIT 1""",
+                (content_hash, user_id)
+            )
+            source = cur.fetchone()
+
+            os.replace(tmp_path, stored_path)
+            cur.execute(
+                "INSERT INTO collections (user_id, filename, stored_path, processing_status, content_hash) VALUES (%s, %s, %s, 'pending', %s) RETURNING id",
+                (user_id, filename, stored_path, content_hash)
+            )
+            cid = cur.fetchone()['id']
+            conn.commit()
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    if source:
+        clone_collection_task.delay(source['id'], stored_path, filename, user_id, cid)
+    else:
+        process_pdf_task.delay(stored_path, filename, user_id, cid)
+
+    return jsonify({"ok": True, "collection_id": cid, "status": "processing", "deduplicated": bool(source)})
+
+def _save_and_hash(f, stored_path, chunk_size=1024 * 1024):
+    """
+    Streams the upload to a temp file next to `stored_path` and returns
+    (temp path, sha256 hex digest). The caller moves it into place.
+    """
+    digest = hashlib.sha256()
+    tmp_path = stored_path + ".part"
+    try:
+        with open(tmp_path, "wb") as out:
+            while True:
+                block = f.stream.read(chunk_size)
+                if not block:
+                    break
+                digest.update(block)
+                out.write(block)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest()
 
 @app.route("/api/collections", methods=["GET"])
 def get_collections():
     user_id = session.get("user_id")
     if not user_id: return jsonify({"ok": False}), 401
     
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, filename, processing_status, created_at FROM collections WHERE user_id = %s ORDER BY created_at DESC", (user_id,))
-    rows = cur.fetchall()
-    conn.close()
+    try:
+        rows, next_cursor = list_collections_for_user(
+            user_id,
+            limit=request.args.get("limit"),
+            cursor=request.args.get("cursor"),
+            filename=request.args.get("filename")
+        )
+    except ValueError:
+        return jsonify({"ok": False, "error": "Invalid cursor"}), 400
     
     data = [dict(r) for r in rows]
-    return jsonify({"ok": True, "collections": data})
+    return jsonify({"ok": True, "collections": data, "next_cursor": next_cursor})
 
 @app.route("/api/collections/<int:collection_id>/download", methods=["GET"])
 def download_collection(collection_id):
@@ -162,46 +245,61 @@ def download_collection(collection_id):
     if not user_id:
         return jsonify({"ok": False, "error": "unauthenticated"}), 401
     
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM collections WHERE id = %s", (collection_id,))
-    col = cur.fetchone()
-    conn.close()
-
+    col = get_collection_file(collection_id)
     if not col or col["user_id"] != user_id:
         return jsonify({"ok": False, "error": "not found"}), 404
     
-    if not os.path.exists(col["stored_path"]):
+    try:
+        st = os.stat(col["stored_path"])
+    except FileNotFoundError:
+        forget_collection_file(collection_id)
         return jsonify({"ok": False, "error": "file missing"}), 404
 
-    return send_file(col["stored_path"], as_attachment=False)
+    # Uploads are written to a temp file and renamed into place, so inode,
+    # size and mtime change whenever the bytes do: a strong validator
+    # without hashing the file. Range, If-Range, If-None-Match and
+    # If-Modified-Since (206/304/416) are handled by send_file.
+    etag = f"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+    resp = send_file(
+        col["stored_path"], mimetype="application/pdf", as_attachment=False,
+        download_name=col["filename"], conditional=True, etag=etag, last_modified=st.st_mtime
+    )
+    # Cache per user, but revalidate on every open (cheap 304s)
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    resp.vary.add("Cookie")
+    return resp
 
 @app.route("/api/collections/<int:collection_id>", methods=["DELETE"])
 def delete_collection_route(collection_id):
     user_id = session.get("user_id")
     if not user_id: return jsonify({"ok": False, "error": "unauthenticated"}), 401
 
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT stored_path FROM collections WHERE id = %s AND user_id = %s", (collection_id, user_id))
-    row = cur.fetchone()
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT filename, stored_path, index_name FROM collections WHERE id = %s AND user_id = %s", (collection_id, user_id))
+        row = cur.fetchone()
     
-    if not row:
-        conn.close()
-        return jsonify({"ok": False, "error": "Not found"}), 404
+        if not row:
+            return jsonify({"ok": False, "error": "Not found"}), 404
         
-    try:
-        if os.path.exists(row['stored_path']):
-            os.remove(row['stored_path'])
+        try:
+            if os.path.exists(row['stored_path']):
+                os.remove(row['stored_path'])
+            page_store.clear(row['stored_path'])
             
-        cur.execute("DELETE FROM collections WHERE id = %s", (collection_id,))
-        conn.commit()
-        return jsonify({"ok": True})
-    except Exception as e:
-        print(f"Delete Error: {e}")
-        return jsonify({"ok": False, "error": "Failed to delete"}), 500
-    finally:
-        conn.close()
+            cur.execute("DELETE FROM collections WHERE id = %s", (collection_id,))
+            conn.commit()
+            forget_collection_file(collection_id)
+            if row['index_name']:
+                delete_documents(row['index_name'], [collection_id])
+            else:
+                delete_chroma_collection(legacy_collection_name(user_id, row['filename']))
+            answer_cache.invalidate_document(user_id, row['filename'])
+            return jsonify({"ok": True})
+        except Exception as e:
+            print(f"Delete Error: {e}")
+            return jsonify({"ok": False, "error": "Failed to delete"}), 500
 
 
 @app.route("/api/chats", methods=["POST"])
@@ -223,41 +321,53 @@ def list_chats_route():
     user_id = session.get("user_id")
     if not user_id: return jsonify({"ok": False, "error": "unauthenticated"}), 401
     
-    chats = list_chats_for_user(user_id)
+    try:
+        chats, next_cursor = list_chats_for_user(
+            user_id,
+            limit=request.args.get("limit"),
+            cursor=request.args.get("cursor"),
+            name=request.args.get("name")
+        )
+    except ValueError:
+        return jsonify({"ok": False, "error": "Invalid cursor"}), 400
     out = [dict(c) for c in chats]
-    return jsonify({"ok": True, "chats": out})
+    return jsonify({"ok": True, "chats": out, "next_cursor": next_cursor})
 
 @app.route("/api/chats/<int:chat_id>", methods=["GET"])
 def get_chat_history(chat_id):
     user_id = session.get("user_id")
     if not user_id: return jsonify({"ok": False, "error": "unauthenticated"}), 401
     
-    memories = get_recent_memories(user_id, chat_id, limit=50)
-    history = [{"role": m["role"], "content": m["content"]} for m in memories]
-    return jsonify({"ok": True, "history": history})
+    try:
+        memories, next_cursor = get_memories_page(
+            user_id, chat_id, limit=request.args.get("limit"), before=request.args.get("before")
+        )
+    except ValueError:
+        return jsonify({"ok": False, "error": "Invalid cursor"}), 400
+    history = [{"id": m["id"], "role": m["role"], "content": m["content"]} for m in memories]
+    return jsonify({"ok": True, "history": history, "next_cursor": next_cursor})
 
 @app.route("/api/chats/<int:chat_id>", methods=["DELETE"])
 def delete_chat_route(chat_id):
     user_id = session.get("user_id")
     if not user_id: return jsonify({"ok": False, "error": "unauthenticated"}), 401
     
-    conn = get_conn()
-    cur = conn.cursor()
     try:
-        cur.execute("SELECT id FROM chats WHERE id = %s AND user_id = %s", (chat_id, user_id))
-        if not cur.fetchone():
-            return jsonify({"ok": False, "error": "Chat not found"}), 404
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT id FROM chats WHERE id = %s AND user_id = %s", (chat_id, user_id))
+            if not cur.fetchone():
+                return jsonify({"ok": False, "error": "Chat not found"}), 404
 
-        cur.execute("DELETE FROM chats WHERE id = %s", (chat_id,))
-        conn.commit()
+            cur.execute("DELETE FROM chats WHERE id = %s", (chat_id,))
+            conn.commit()
         return jsonify({"ok": True})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
-    finally:
-        conn.close()
 
 @app.route("/api/chat", methods=["POST"])
 def chat_route():
+    t_request = time.perf_counter()
     user_id = session.get("user_id")
     if not user_id: return jsonify({"ok": False, "error": "Unauthorized"}), 401
 
@@ -265,28 +375,52 @@ def chat_route():
     query = data.get("query")
     chat_id = data.get("chat_id")
     raw_name = data.get("collection_name")
+    # Cross-document questions: a list of collection ids, or scope="all"
+    collection_ids = data.get("collection_ids")
+    search_all = data.get("scope") == "all"
     mode = data.get("mode", "discrete") 
     
-    if not raw_name:
+    if not raw_name and not collection_ids and not search_all:
         return jsonify({"ok": False, "error": "No document selected"}), 400
 
-    conn = get_conn()
-    cur = conn.cursor()
+    if raw_name and raw_name.startswith(f"user_{user_id}__"):
+        raw_name = raw_name[len(f"user_{user_id}__"):]
+
+    docs = []
     try:
-        if chat_id:
-            cur.execute("SELECT id FROM chats WHERE id = %s AND user_id = %s", (chat_id, user_id))
-            if not cur.fetchone():
-                chat_id = None 
+        with metrics.span("chat_stage_seconds", stage="db_chat_resolution"), get_conn() as conn:
+            cur = conn.cursor()
+            if search_all:
+                cur.execute(
+                    "SELECT id, user_id, filename, index_name FROM collections WHERE user_id = %s AND processing_status IN ('completed', 'partial')",
+                    (user_id,)
+                )
+                docs = cur.fetchall()
+            elif collection_ids:
+                cur.execute(
+                    "SELECT id, user_id, filename, index_name FROM collections WHERE user_id = %s AND id = ANY(%s)",
+                    (user_id, [int(i) for i in collection_ids])
+                )
+                docs = cur.fetchall()
+            else:
+                cur.execute(
+                    "SELECT id, user_id, filename, index_name FROM collections WHERE user_id = %s AND filename = %s ORDER BY id DESC LIMIT 1",
+                    (user_id, raw_name)
+                )
+                docs = cur.fetchall()
 
-        if not chat_id:
-            cur.execute("SELECT id FROM collections WHERE user_id = %s AND filename = %s", (user_id, raw_name))
-            col_row = cur.fetchone()
-            
-            if col_row:
-                collection_id = col_row['id']
+            if chat_id:
+                cur.execute("SELECT id FROM chats WHERE id = %s AND user_id = %s", (chat_id, user_id))
+                if not cur.fetchone():
+                    chat_id = None 
+
+            # Single-document chats are reused per collection; cross-document
+            # questions only get history when the client passes a chat_id.
+            if not chat_id and raw_name and docs:
+                collection_id = docs[0]['id']
                 cur.execute("SELECT id FROM chats WHERE collection_id = %s ORDER BY created_at DESC LIMIT 1", (collection_id,))
                 existing_chat = cur.fetchone()
-                
+            
                 if existing_chat:
                     chat_id = existing_chat['id']
                 else:
@@ -298,12 +432,14 @@ def chat_route():
                     conn.commit()
     except Exception as e:
         print(f"Chat ID Error: {e}")
-    finally:
-        conn.close()
 
-    collection_name = f"user_{user_id}__{raw_name}"
-    if raw_name.startswith(f"user_{user_id}__"):
-        collection_name = raw_name
+    if not docs:
+        return jsonify({"ok": False, "error": "Document not found"}), 404
+
+    if raw_name:
+        cache_scope = answer_cache.document_scope(user_id, docs[0]['filename'])
+    else:
+        cache_scope = answer_cache.multi_scope(user_id, [d['id'] for d in docs])
 
     if chat_id:
         try:
@@ -313,17 +449,33 @@ def chat_route():
 
     def generate():
         try:
-            result = run_agent(query, collection_name, mode=mode)
+            with metrics.span("chat_stage_seconds", stage="query_embedding"):
+                q_emb = get_query_embedding(query)
+            with metrics.span("chat_stage_seconds", stage="answer_cache_lookup"):
+                cached = answer_cache.lookup(cache_scope, mode, q_emb)
+            if cached:
+                print(f"DEBUG: Answer cache hit (similarity {cached['similarity']:.3f})")
+                result = {"stream": iter([cached["answer"]]), "sources": cached["sources"]}
+            else:
+                result = run_agent(query, docs, mode=mode)
             stream_gen = result["stream"]
             sources = result["sources"]
 
-            import json
             yield json.dumps({"type": "sources", "data": sources, "chat_id": chat_id}) + "\n"
 
             full_answer = ""
+            cached_label = "true" if cached else "false"
+            first_token = True
             for chunk in stream_gen:
+                if first_token:
+                    first_token = False
+                    metrics.observe("chat_stage_seconds", time.perf_counter() - t_request, stage="time_to_first_token", cached=cached_label)
                 full_answer += chunk
                 yield json.dumps({"type": "token", "data": chunk}) + "\n"
+            metrics.observe("chat_stage_seconds", time.perf_counter() - t_request, stage="stream_total", cached=cached_label)
+
+            if not cached and full_answer.strip() and ALL_MODELS_FAILED not in full_answer:
+                answer_cache.store(cache_scope, mode, query, q_emb, full_answer, sources, user_id)
 
             if chat_id:
                 with app.app_context():
@@ -334,10 +486,8 @@ def chat_route():
 
         except Exception as e:
             print(f"Stream Error: {e}")
-            import json
             yield json.dumps({"type": "error", "data": str(e)}) + "\n"
 
-    from flask import Response
     return Response(generate(), mimetype='application/x-ndjson')
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
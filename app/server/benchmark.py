@@ -0,0 +1,263 @@
+"""
+Micro-benchmarks for the ingestion and retrieval hot paths, run offline on
+generated PDFs (no Gemini, Serper, Postgres or Redis needed).
+
+    python benchmark.py                          # default sizes, compare to baseline
+    python benchmark.py --sizes 10,100 --repeat 5
+    python benchmark.py --save-baseline          # record the current numbers
+    python benchmark.py --hash-embeddings        # time Chroma without the model
+
+Each synthetic document mixes text pages with image-only pages (rendered
+text, so OCR has real work to do). Timed per document size:
+
+    extract_text_from_pdf   text layer only, and with OCR when tesseract exists
+    chunk_pages             the default 1000/200 chunking
+    upsert_chunks           encode + index into a throwaway Chroma directory
+    semantic_search         a fixed set of queries, query cache cleared first
+    _format_prompt          packing the top results plus web snippets
+
+Results go to bench_results.json. When a baseline exists, any benchmark
+whose median is more than --tolerance slower is reported and the exit
+status is 1.
+"""
+import os
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import statistics
+import contextlib
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_RESULTS = os.path.join(BASE_DIR, "bench_results.json")
+DEFAULT_BASELINE = os.path.join(BASE_DIR, "bench_baseline.json")
+
+# Isolate the run before any project module reads its configuration: no
+# external services, no persistent caches, and a scratch vector store.
+for _var in ("GEMINI_API_KEY", "SERPER_API_KEY", "EMBED_SERVICE_SOCKET"):
+    os.environ.pop(_var, None)
+os.environ["EMBED_CACHE_ENABLED"] = "0"
+os.environ["METRICS_ENABLED"] = "0"
+_CHROMA_TMP = tempfile.mkdtemp(prefix="bench_chroma_")
+os.environ["CHROMA_DIR"] = _CHROMA_TMP
+
+import fitz
+import embedding_manager
+from embedding_model import EMBED_MODEL_ID
+from pdf_parser import extract_text_from_pdf, chunk_pages
+from embedding_manager import upsert_chunks, semantic_search, delete_collection, query_cache
+from llm import _format_prompt
+
+VOCAB = (
+    "invoice payment contract supplier warranty delivery tenant deposit agreement clause "
+    "termination notice arbitration liability insurance schedule amendment party obligation "
+    "cell protein enzyme energy membrane receptor genome sequence mutation pathway "
+    "database index query transaction latency throughput cache replica partition shard "
+    "network packet socket protocol handshake certificate encryption signature token session "
+    "the a of to and in for with on by from that this is are was be as at or"
+).split()
+
+QUERIES = [
+    "When is the invoice payment due?",
+    "How can either party terminate the agreement?",
+    "What does the warranty cover?",
+    "How do enzymes affect the reaction pathway?",
+    "Why does a database index speed up queries?",
+    "What happens during the protocol handshake?",
+    "Who is responsible for the deposit?",
+    "How is replica latency measured?",
+]
+
+WEB_SOURCES = [
+    {"title": f"Reference {i}", "url": f"https://example.com/{i}", "snippet": " ".join(VOCAB[i:i + 40])}
+    for i in range(5)
+]
+
+def _paragraphs(rng, n_words):
+    words = [rng.choice(VOCAB) for _ in range(n_words)]
+    # Sentence and paragraph breaks so chunk boundaries look like real text
+    out = []
+    for i in range(0, len(words), 18):
+        out.append(" ".join(words[i:i + 18]).capitalize() + ".")
+    return "\n".join(" ".join(out[i:i + 5]) for i in range(0, len(out), 5))
+
+def make_pdf(path, pages, image_ratio, seed=0):
+    """Writes a PDF where roughly `image_ratio` of the pages have no text layer."""
+    rng = random.Random(seed)
+    doc = fitz.open()
+    image_every = round(1 / image_ratio) if image_ratio > 0 else 0
+    for i in range(pages):
+        text = _paragraphs(rng, 420)
+        page = doc.new_page()
+        rect = page.rect + (50, 50, -50, -50)
+        if image_every and i % image_every == image_every - 1:
+            scratch = fitz.open()
+            src = scratch.new_page()
+            src.insert_textbox(rect, text, fontsize=10)
+            pix = src.get_pixmap(dpi=150)
+            page.insert_image(page.rect, pixmap=pix)
+            scratch.close()
+        else:
+            page.insert_textbox(rect, text, fontsize=10)
+    doc.save(path)
+    doc.close()
+
+def _tesseract_available():
+    try:
+        import pytesseract
+        pytesseract.get_tesseract_version()
+        return True
+    except Exception:
+        return False
+
+def _hash_encode(texts, batch_size=None):
+    """Deterministic stand-in vectors (384-d, like MiniLM) for --hash-embeddings."""
+    out = []
+    for t in texts:
+        digest = hashlib.sha256(t.encode("utf-8")).digest()
+        rng = random.Random(digest)
+        out.append([rng.uniform(-1, 1) for _ in range(384)])
+    return out
+
+def timed(fn, repeat, setup=None):
+    """Runs fn `repeat` times (after an untimed warm-up) and returns seconds per run plus fn's last result."""
+    if setup:
+        setup()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = fn()
+    runs = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            result = fn()
+            runs.append(time.perf_counter() - t0)
+    return runs, result
+
+def _record(results, name, runs, items, unit):
+    median = statistics.median(runs)
+    results[name] = {
+        "median_s": round(median, 6),
+        "min_s": round(min(runs), 6),
+        "runs": len(runs),
+        "items": items,
+        "unit": unit,
+        "per_item_ms": round(median * 1000 / items, 4) if items else None,
+    }
+    print(f"{name:<48} {median * 1000:10.2f} ms   ({items} {unit})")
+
+def run_size(pages, args, workdir, results, ocr):
+    path = os.path.join(workdir, f"bench_{pages}.pdf")
+    make_pdf(path, pages, args.image_ratio, seed=pages)
+
+    runs, extracted = timed(lambda: extract_text_from_pdf(path, ocr_if_needed=False), args.repeat)
+    _record(results, f"extract_text_from_pdf[text_only,pages={pages}]", runs, pages, "pages")
+    if ocr:
+        runs, extracted = timed(lambda: extract_text_from_pdf(path, ocr_if_needed=True), args.repeat)
+        _record(results, f"extract_text_from_pdf[ocr,pages={pages}]", runs, pages, "pages")
+
+    runs, chunks = timed(lambda: chunk_pages(extracted), args.repeat)
+    _record(results, f"chunk_pages[pages={pages}]", runs, len(chunks), "chunks")
+
+    name = f"bench_{pages}"
+    runs, _ = timed(lambda: upsert_chunks(name, chunks), args.repeat, setup=lambda: delete_collection(name))
+    _record(results, f"upsert_chunks[pages={pages}]", runs, len(chunks), "chunks")
+
+    def search_all():
+        return [semantic_search(name, q, top_k=args.top_k) for q in QUERIES]
+    runs, hits = timed(search_all, args.repeat, setup=query_cache.clear)
+    _record(results, f"semantic_search[pages={pages}]", runs, len(QUERIES), "queries")
+
+    def format_all():
+        return [_format_prompt(q, h, WEB_SOURCES, "hybrid") for q, h in zip(QUERIES, hits)]
+    runs, _ = timed(format_all, args.repeat)
+    _record(results, f"_format_prompt[pages={pages}]", runs, len(QUERIES), "prompts")
+
+    delete_collection(name)
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, cur in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        ratio = cur["median_s"] / base["median_s"] if base["median_s"] else 1.0
+        if ratio > 1 + tolerance:
+            regressions.append((name, base["median_s"], cur["median_s"], ratio))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="5,25,100", help="comma-separated page counts")
+    parser.add_argument("--image-ratio", type=float, default=0.2, help="fraction of image-only pages")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--no-ocr", action="store_true", help="skip the OCR extraction benchmark")
+    parser.add_argument("--hash-embeddings", action="store_true", help="replace the model with hashed vectors")
+    parser.add_argument("--output", default=DEFAULT_RESULTS)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="write results to the baseline file too")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown vs baseline (0.25 = 25%%)")
+    args = parser.parse_args(argv)
+
+    if args.hash_embeddings:
+        embedding_manager._encode_batch = _hash_encode
+    ocr = not args.no_ocr and _tesseract_available()
+    if not args.no_ocr and not ocr:
+        print("tesseract not found; OCR extraction is not benchmarked")
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="bench_pdf_")
+    try:
+        for pages in [int(s) for s in args.sizes.split(",") if s.strip()]:
+            run_size(pages, args, workdir, results, ocr)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        shutil.rmtree(_CHROMA_TMP, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "embedding": "hash" if args.hash_embeddings else EMBED_MODEL_ID,
+            "image_ratio": args.image_ratio,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nwrote {args.output}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"saved baseline to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("no baseline to compare against (run with --save-baseline)")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("meta", {}).get("embedding") != report["meta"]["embedding"]:
+        print(f"warning: baseline used embedding {baseline.get('meta', {}).get('embedding')!r}")
+
+    regressions = compare(results, baseline.get("results", {}), args.tolerance)
+    for name, base, cur, ratio in regressions:
+        print(f"REGRESSION {name}: {base * 1000:.2f} ms -> {cur * 1000:.2f} ms ({ratio:.2f}x)")
+    if not regressions:
+        print(f"no regressions beyond {args.tolerance:.0%} of baseline")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+"""
+Turns retrieved chunks into the document context of a prompt.
+
+Chunks come from iter_chunks with overlapping windows, so neighbouring
+hits on a page repeat each other's text. pack_context merges overlapping
+or touching spans of the same page (using the start/end offsets stored
+with each chunk), drops spans that are near-copies of one already kept,
+and then fills a token budget in relevance order.
+"""
+import os
+import re
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Rough chars-per-token for English prose; only used for budgeting.
+CHARS_PER_TOKEN = 4
+# Spans sharing at least this fraction of their shingles with a kept span are dropped
+DUPLICATE_THRESHOLD = 0.85
+# Below this many tokens of headroom a span is skipped rather than cut
+MIN_PARTIAL_TOKENS = 64
+
+_WS = re.compile(r"\s+")
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def _join_overlapping(left, right, overlap):
+    """
+    Appends `right` to `left` when the two texts were cut from the same page
+    with `overlap` characters in common. Chunk texts are stripped, so the
+    seam is found by locating the tail of `left` near the start of `right`.
+    """
+    if overlap <= 0:
+        return f"{left} {right}"
+    anchor = left[-min(len(left), overlap, 48):]
+    pos = right.find(anchor, 0, overlap + len(anchor))
+    if pos >= 0:
+        return left + right[pos + len(anchor):]
+    return left + right[overlap:]
+
+def merge_spans(chunks):
+    """
+    chunks: retrieval results ({"text", "meta"}) ordered best first.
+    Returns merged spans ordered by their best member's rank.
+    """
+    groups = {}
+    for rank, ch in enumerate(chunks):
+        text = (ch.get("text") or "").strip()
+        if not text:
+            continue
+        meta = ch.get("meta") or {}
+        doc = meta.get("collection_id", meta.get("filename"))
+        key = (doc, meta.get("page"))
+        start = meta.get("start")
+        end = meta.get("end")
+        if start is None or end is None:
+            # No offsets (older index): keep the chunk as its own span
+            key = key + (rank,)
+            start, end = 0, len(text)
+        groups.setdefault(key, []).append({
+            "rank": rank, "start": start, "end": end, "text": text,
+            "page": meta.get("page"), "filename": meta.get("filename"),
+        })
+
+    spans = []
+    for members in groups.values():
+        members.sort(key=lambda s: (s["start"], s["end"]))
+        cur = dict(members[0])
+        for nxt in members[1:]:
+            if nxt["start"] <= cur["end"]:
+                if nxt["end"] > cur["end"]:
+                    cur["text"] = _join_overlapping(cur["text"], nxt["text"], cur["end"] - nxt["start"])
+                    cur["end"] = nxt["end"]
+                cur["rank"] = min(cur["rank"], nxt["rank"])
+            else:
+                spans.append(cur)
+                cur = dict(nxt)
+        spans.append(cur)
+
+    spans.sort(key=lambda s: s["rank"])
+    return spans
+
+def _shingles(text, n=5):
+    words = _WS.sub(" ", text.lower()).split(" ")
+    if len(words) <= n:
+        return {hash(" ".join(words))}
+    return {hash(" ".join(words[i:i + n])) for i in range(len(words) - n + 1)}
+
+def drop_near_duplicates(spans, threshold=DUPLICATE_THRESHOLD):
+    """Keeps the better-ranked copy of spans whose text largely repeats (headers, boilerplate, re-uploads)."""
+    kept = []
+    kept_shingles = []
+    for span in spans:
+        sh = _shingles(span["text"])
+        if any(len(sh & other) >= threshold * len(sh) for other in kept_shingles):
+            continue
+        kept.append(span)
+        kept_shingles.append(sh)
+    return kept
+
+def pack_context(chunks, token_budget=None):
+    """
+    Merges, de-duplicates and budgets retrieved chunks. Returns the spans
+    that fit, best first, each with page, filename and text.
+    """
+    token_budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    packed = []
+    remaining = token_budget
+    for span in drop_near_duplicates(merge_spans(chunks)):
+        cost = estimate_tokens(span["text"])
+        if cost <= remaining:
+            packed.append(span)
+            remaining -= cost
+        elif remaining >= MIN_PARTIAL_TOKENS:
+            cut = span["text"][:remaining * CHARS_PER_TOKEN]
+            # End on a word boundary so the model doesn't see a broken token
+            cut = cut[:cut.rfind(" ")] if " " in cut else cut
+            packed.append(dict(span, text=cut + " …"))
+            remaining = 0
+        if remaining < MIN_PARTIAL_TOKENS:
+            break
+    return packed
@@ -1,5 +1,9 @@
 import os
 import time
+import sys
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
 import psycopg2
 from psycopg2.extras import RealDictCursor
 
@@ -8,73 +12,347 @@ DB_NAME = os.getenv("POSTGRES_DB", "intellidocs")
 DB_USER = os.getenv("POSTGRES_USER", "user")
 DB_PASS = os.getenv("POSTGRES_PASSWORD", "password")
 
-def get_conn():
-    """Establishes a connection to PostgreSQL with retries."""
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# Connections idle longer than this are pinged before being handed out
+DB_POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", "30"))
+
+def _connect():
+    """Opens a new connection to PostgreSQL, retrying with a short backoff."""
+    delay = 0.1
     for i in range(5):
         try:
-            conn = psycopg2.connect(
+            return psycopg2.connect(
                 host=DB_HOST,
                 database=DB_NAME,
                 user=DB_USER,
                 password=DB_PASS,
-                cursor_factory=RealDictCursor
+                cursor_factory=RealDictCursor,
+                connect_timeout=5
             )
-            return conn
         except psycopg2.OperationalError:
-            time.sleep(2)
+            time.sleep(delay)
+            delay *= 2
     raise Exception("Could not connect to the database.")
 
+class ConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections. Callers block up to `timeout`
+    seconds when all `maxconn` connections are checked out.
+    """
+
+    def __init__(self, minconn, maxconn, timeout):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._idle = []
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._stats = {"created": 0, "closed": 0, "checkouts": 0, "waits": 0, "timeouts": 0, "health_failures": 0}
+        for _ in range(minconn):
+            self._idle.append((_connect(), time.monotonic()))
+            self._stats["created"] += 1
+
+    def _healthy(self, conn, idle_for):
+        if conn.closed:
+            return False
+        if idle_for < DB_POOL_PING_AFTER:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._stats["closed"] += 1
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        conn = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._in_use + len(self._idle) < self.maxconn:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise Exception("Timed out waiting for a database connection.")
+                self._stats["waits"] += 1
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self._stats["checkouts"] += 1
+
+        try:
+            if conn is not None and not self._healthy(conn, time.monotonic() - last_used):
+                with self._cond:
+                    self._stats["health_failures"] += 1
+                self._close(conn)
+                conn = None
+            if conn is None:
+                conn = _connect()
+                with self._cond:
+                    self._stats["created"] += 1
+            return conn
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn):
+        discard = bool(conn.closed)
+        if not discard:
+            try:
+                # Reset whatever transaction the caller left open
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard:
+            self._close(conn)
+        with self._cond:
+            self._in_use -= 1
+            if not discard:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return dict(
+                self._stats,
+                min=self.minconn,
+                max=self.maxconn,
+                in_use=self._in_use,
+                idle=len(self._idle),
+            )
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    # A pool inherited across fork() shares sockets with the parent; start fresh
+    if _pool is None or _pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT)
+    return _pool
+
+@contextmanager
+def get_conn():
+    """Checks a connection out of the pool for the duration of a `with` block."""
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+def pool_stats():
+    return get_pool().stats() if _pool is not None else {}
+
+# Schema migrations, applied once each and in order by migrate(). Plain SQL
+# steps of one migration share a transaction; Index steps are built with
+# CREATE INDEX CONCURRENTLY in autocommit so large tables stay writable.
+Index = namedtuple("Index", ["name", "definition"])
+
+MIGRATIONS = [
+    (1, "initial schema", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS collections (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            filename TEXT NOT NULL,
+            stored_path TEXT NOT NULL,
+            processing_status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chats (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            name TEXT,
+            collection_id INTEGER REFERENCES collections(id) ON DELETE SET NULL,
+            mode TEXT DEFAULT 'discrete',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS memories (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            chat_id INTEGER REFERENCES chats(id) ON DELETE CASCADE,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+    ]),
+    (2, "ingestion progress and content hash", [
+        "ALTER TABLE collections ADD COLUMN IF NOT EXISTS pages_done INTEGER DEFAULT 0;",
+        "ALTER TABLE collections ADD COLUMN IF NOT EXISTS pages_total INTEGER;",
+        "ALTER TABLE collections ADD COLUMN IF NOT EXISTS content_hash TEXT;",
+    ]),
+    (3, "hot-path indexes", [
+        # History loading; leading chat_id also serves the ON DELETE CASCADE from chats
+        Index("memories_chat_user_id_idx", "memories (chat_id, user_id, id)"),
+        Index("chats_collection_created_idx", "chats (collection_id, created_at DESC)"),
+        Index("chats_user_created_idx", "chats (user_id, created_at DESC)"),
+        Index("collections_user_filename_idx", "collections (user_id, filename)"),
+        Index("collections_user_created_idx", "collections (user_id, created_at DESC)"),
+        Index("collections_content_hash_idx", "collections (content_hash) WHERE processing_status = 'completed'"),
+    ]),
+    (4, "keyset pagination indexes", [
+        # (created_at, id) row comparisons need the id tie-breaker in the index
+        "DROP INDEX IF EXISTS chats_user_created_idx;",
+        "DROP INDEX IF EXISTS collections_user_created_idx;",
+        Index("chats_user_created_id_idx", "chats (user_id, created_at DESC, id DESC)"),
+        Index("collections_user_created_id_idx", "collections (user_id, created_at DESC, id DESC)"),
+    ]),
+    (5, "shared per-user vector index", [
+        # Chroma collection holding the document's chunks; NULL means the
+        # legacy per-file collection user_{user_id}__{filename}
+        "ALTER TABLE collections ADD COLUMN IF NOT EXISTS index_name TEXT;",
+    ]),
+    (6, "per-user index pointer for re-indexing", [
+        # Index new uploads go to; NULL means docs_user_{id}. A re-index
+        # builds a fresh collection and swaps this and the rows over to it.
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS index_name TEXT;",
+    ]),
+    (7, "ingest generation for re-index swaps", [
+        # Bumped every time a document is (re-)ingested, so a re-index only
+        # swaps rows whose content is still the one it rebuilt.
+        "ALTER TABLE collections ADD COLUMN IF NOT EXISTS ingest_generation INTEGER NOT NULL DEFAULT 0;",
+    ]),
+    (8, "finished page ranges of a fanned-out ingest", [
+        # First page of every range counted in pages_done, so a redelivered
+        # range task is not counted twice.
+        "ALTER TABLE collections ADD COLUMN IF NOT EXISTS ranges_done INTEGER[] NOT NULL DEFAULT '{}';",
+    ]),
+]
+
+# Arbitrary key for pg_advisory_lock so concurrent workers migrate one at a time
+_MIGRATION_LOCK_ID = 72110001
+
+def _ensure_index(cur, index):
+    # A failed concurrent build leaves an INVALID index that IF NOT EXISTS would skip
+    cur.execute(
+        "SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid WHERE c.relname = %s",
+        (index.name,)
+    )
+    row = cur.fetchone()
+    if row and not row["indisvalid"]:
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}")
+    cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} ON {index.definition}")
+
+def migrate():
+    """Applies pending MIGRATIONS and returns the versions applied."""
+    conn = _connect()
+    conn.autocommit = True
+    applied_now = []
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_lock(%s)", (_MIGRATION_LOCK_ID,))
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """)
+        cur.execute("SELECT version FROM schema_migrations")
+        applied = {r["version"] for r in cur.fetchall()}
+
+        for version, description, steps in MIGRATIONS:
+            if version in applied:
+                continue
+            print(f"Applying migration {version}: {description}")
+            sql_steps = [st for st in steps if not isinstance(st, Index)]
+            cur.execute("BEGIN")
+            try:
+                for st in sql_steps:
+                    cur.execute(st)
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+            for st in steps:
+                if isinstance(st, Index):
+                    _ensure_index(cur, st)
+            cur.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                (version, description)
+            )
+            applied_now.append(version)
+    finally:
+        conn.close()
+    return applied_now
+
 def init_db():
-    conn = get_conn()
-    cur = conn.cursor()
-    
-    # Users
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id SERIAL PRIMARY KEY,
-        username TEXT UNIQUE NOT NULL,
-        email TEXT UNIQUE NOT NULL,
-        password_hash TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    """)
-    
-    # Collections (PDFs)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS collections (
-        id SERIAL PRIMARY KEY,
-        user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-        filename TEXT NOT NULL,
-        stored_path TEXT NOT NULL,
-        processing_status TEXT DEFAULT 'pending',
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    """)
-    
-    # Chats
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS chats (
-        id SERIAL PRIMARY KEY,
-        user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-        name TEXT,
-        collection_id INTEGER REFERENCES collections(id) ON DELETE SET NULL,
-        mode TEXT DEFAULT 'discrete',
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    """)
-    
-    # Memories
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS memories (
-        id SERIAL PRIMARY KEY,
-        user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-        chat_id INTEGER REFERENCES chats(id) ON DELETE CASCADE,
-        role TEXT NOT NULL,
-        content TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    """)
-    
-    conn.commit()
-    conn.close()
-    print("✅ Production Database Initialized")
\ No newline at end of file
+    migrate()
+    print("✅ Production Database Initialized")
+
+# The queries on the request path, for checking their plans with
+# `python database.py explain`. Parameters are sampled from recent rows.
+HOT_QUERIES = [
+    ("chat history (page)",
+     "SELECT id, role, content FROM memories WHERE chat_id = %(chat_id)s AND user_id = %(user_id)s ORDER BY id DESC LIMIT 51"),
+    ("latest chat for collection",
+     "SELECT id FROM chats WHERE collection_id = %(collection_id)s ORDER BY created_at DESC LIMIT 1"),
+    ("chats for user (page)",
+     "SELECT id, name, collection_id, mode, created_at FROM chats WHERE user_id = %(user_id)s ORDER BY created_at DESC, id DESC LIMIT 51"),
+    ("collection by filename",
+     "SELECT id FROM collections WHERE user_id = %(user_id)s AND filename = %(filename)s"),
+    ("collections for user (page)",
+     "SELECT id, filename, processing_status, pages_done, pages_total, created_at FROM collections WHERE user_id = %(user_id)s ORDER BY created_at DESC, id DESC LIMIT 51"),
+    ("completed upload by hash",
+     "SELECT id FROM collections WHERE content_hash = %(content_hash)s AND processing_status = 'completed' ORDER BY id DESC LIMIT 1"),
+]
+
+def explain_hot_queries(analyze=False):
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT user_id, chat_id FROM memories ORDER BY id DESC LIMIT 1")
+        params = dict(cur.fetchone() or {"user_id": 0, "chat_id": 0})
+        cur.execute("SELECT id, filename, content_hash FROM collections ORDER BY id DESC LIMIT 1")
+        row = cur.fetchone() or {"id": 0, "filename": "", "content_hash": ""}
+        params.update(collection_id=row["id"], filename=row["filename"], content_hash=row["content_hash"] or "")
+
+        prefix = "EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN "
+        for name, sql in HOT_QUERIES:
+            cur.execute(prefix + sql, params)
+            print(f"== {name}")
+            for r in cur.fetchall():
+                print("   " + r["QUERY PLAN"])
+            print()
+
+if __name__ == "__main__":
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "migrate"
+    if cmd == "migrate":
+        print(f"Applied: {migrate() or 'nothing, schema is up to date'}")
+    elif cmd == "explain":
+        explain_hot_queries(analyze="--analyze" in sys.argv)
+    else:
+        print("usage: python database.py [migrate | explain [--analyze]]")
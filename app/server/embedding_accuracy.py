@@ -0,0 +1,142 @@
+"""
+Compares an embedding backend against the fp32 reference on a fixed corpus.
+
+    python embedding_accuracy.py --backend int8
+    python embedding_accuracy.py --backend onnx --corpus passages.txt --queries questions.txt
+
+Reports per-text cosine agreement with fp32, how much of the fp32 top-k
+retrieval each backend reproduces, and encode throughput, as JSON.
+"""
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from embedding_model import load_model
+
+CORPUS = [
+    "The invoice must be paid within thirty days of the delivery date.",
+    "Late payments accrue interest at two percent per month on the outstanding balance.",
+    "Either party may terminate this agreement with ninety days written notice.",
+    "The supplier warrants that all goods are free from defects for one year.",
+    "Confidential information shall not be disclosed to any third party without consent.",
+    "This agreement is governed by the laws of the State of New York.",
+    "Disputes will be resolved by binding arbitration in the city of Chicago.",
+    "The tenant is responsible for routine maintenance and minor repairs.",
+    "Rent is due on the first business day of each calendar month.",
+    "A security deposit equal to two months rent is required at signing.",
+    "Photosynthesis converts light energy into chemical energy stored in glucose.",
+    "Mitochondria generate most of the cell's supply of adenosine triphosphate.",
+    "DNA replication is semi-conservative, each new helix keeping one original strand.",
+    "Enzymes lower the activation energy required for biochemical reactions.",
+    "The heart pumps oxygenated blood through the aorta to the rest of the body.",
+    "Python lists are dynamic arrays that support amortized constant-time appends.",
+    "A hash table maps keys to values using a hash function to pick a bucket.",
+    "Binary search finds an element in a sorted array in logarithmic time.",
+    "Garbage collection reclaims memory occupied by objects no longer referenced.",
+    "A database index speeds up lookups at the cost of slower writes.",
+    "Transactions guarantee atomicity, consistency, isolation and durability.",
+    "TCP provides reliable, ordered delivery of a byte stream between applications.",
+    "HTTP caching uses ETag and Last-Modified headers for conditional requests.",
+    "Containers share the host kernel while isolating processes and file systems.",
+    "Gradient descent updates parameters in the direction that reduces the loss.",
+    "Overfitting happens when a model memorizes training data and fails to generalize.",
+    "Transformers use self-attention to weigh the relevance of every token pair.",
+    "Quantization stores weights in lower precision to reduce memory and compute.",
+    "The central bank raised interest rates to curb persistent inflation.",
+    "Quarterly revenue grew twelve percent driven by strong subscription sales.",
+    "The company reported a net loss due to one-time restructuring charges.",
+    "Diversification reduces portfolio risk by spreading investments across assets.",
+    "The Treaty of Versailles formally ended the First World War in 1919.",
+    "The printing press enabled the rapid spread of information across Europe.",
+    "The Great Wall was built over centuries to protect against northern invasions.",
+    "Vitamin D is synthesized in the skin when exposed to sunlight.",
+    "Regular aerobic exercise lowers resting heart rate and blood pressure.",
+    "Adequate sleep is essential for memory consolidation and learning.",
+    "The recipe calls for two cups of flour, one egg and a pinch of salt.",
+    "Bake the bread at two hundred degrees for forty minutes until golden.",
+]
+
+QUERIES = [
+    "When is payment due on an invoice?",
+    "What happens if I pay late?",
+    "How can the contract be ended?",
+    "Which state's law applies?",
+    "Who handles repairs in the apartment?",
+    "How much is the deposit?",
+    "How do plants make energy from sunlight?",
+    "What produces ATP in cells?",
+    "How fast is binary search?",
+    "Why do indexes slow down inserts?",
+    "What does ACID stand for?",
+    "How do ETags work?",
+    "What is self-attention?",
+    "Why quantize a neural network?",
+    "Why did the central bank raise rates?",
+    "What caused the net loss?",
+    "When did World War One end?",
+    "How does exercise affect blood pressure?",
+    "How long should the bread bake?",
+]
+
+def _read_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+def _encode(model, texts, batch_size):
+    t0 = time.perf_counter()
+    vecs = np.asarray(model.encode(texts, batch_size=batch_size, normalize_embeddings=True), dtype=np.float32)
+    return vecs, time.perf_counter() - t0
+
+def _top_k(doc_vecs, query_vecs, k):
+    sims = query_vecs @ doc_vecs.T
+    return np.argsort(-sims, axis=1)[:, :k]
+
+def compare(backend, corpus, queries, k=5, batch_size=64, repeats=3):
+    ref_model = load_model("fp32")
+    cand_model = load_model(backend)
+    # Warm up both so load-time work doesn't count toward throughput
+    _encode(ref_model, corpus[:8], batch_size)
+    _encode(cand_model, corpus[:8], batch_size)
+
+    report = {"backend": backend, "corpus_size": len(corpus), "queries": len(queries), "k": k}
+    timings = {}
+    for name, model in (("fp32", ref_model), (backend, cand_model)):
+        best = min(_encode(model, corpus, batch_size)[1] for _ in range(repeats))
+        timings[name] = round(len(corpus) / best, 1)
+    report["texts_per_sec"] = timings
+    report["speedup"] = round(timings[backend] / timings["fp32"], 2)
+
+    ref_docs, _ = _encode(ref_model, corpus, batch_size)
+    cand_docs, _ = _encode(cand_model, corpus, batch_size)
+    ref_q, _ = _encode(ref_model, queries, batch_size)
+    cand_q, _ = _encode(cand_model, queries, batch_size)
+
+    agreement = np.sum(np.vstack([ref_docs, ref_q]) * np.vstack([cand_docs, cand_q]), axis=1)
+    report["cosine_to_fp32"] = {
+        "mean": round(float(agreement.mean()), 5),
+        "min": round(float(agreement.min()), 5),
+    }
+
+    k = min(k, len(corpus))
+    report["k"] = k
+    ref_top = _top_k(ref_docs, ref_q, k)
+    cand_top = _top_k(cand_docs, cand_q, k)
+    overlap = [len(set(a) & set(b)) / k for a, b in zip(ref_top, cand_top)]
+    report[f"recall@{k}_vs_fp32"] = round(float(np.mean(overlap)), 4)
+    report["top1_agreement"] = round(float(np.mean(ref_top[:, 0] == cand_top[:, 0])), 4)
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", default="int8", choices=["int8", "onnx", "fp32"])
+    parser.add_argument("--corpus", help="text file, one passage per line (default: built-in corpus)")
+    parser.add_argument("--queries", help="text file, one query per line (default: built-in queries)")
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=64)
+    args = parser.parse_args()
+
+    corpus = _read_lines(args.corpus) if args.corpus else CORPUS
+    queries = _read_lines(args.queries) if args.queries else QUERIES
+    json.dump(compare(args.backend, corpus, queries, k=args.k, batch_size=args.batch_size), sys.stdout, indent=2)
+    print()
@@ -0,0 +1,123 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+import metrics
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+EMBED_CACHE_ENABLED = os.getenv("EMBED_CACHE_ENABLED", "1") == "1"
+# Point this at a volume shared by every worker on the host (see
+# docker-compose.yml); otherwise each container keeps, and loses, its own copy
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", os.path.join(BASE_DIR, "..", "embed_cache.sqlite3"))
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "500000"))
+# How many inserts to accumulate before checking the size limit
+_EVICT_CHECK_EVERY = 1000
+
+def _key(model_name, text):
+    return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).digest()
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed store of chunk embeddings shared by every
+    process on the host. Vectors are keyed by sha256(model name + text) and
+    stored as float32; the least recently used rows are evicted once the
+    table grows past `max_entries`.
+    """
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._inserted_since_check = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key BLOB PRIMARY KEY, vec BLOB NOT NULL, last_used REAL NOT NULL) WITHOUT ROWID"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get_many(self, model_name, texts):
+        """Returns a list aligned with `texts`, holding None for misses."""
+        keys = [_key(model_name, t) for t in texts]
+        found = {}
+        conn = self._conn()
+        # Stay well under SQLite's bound-parameter limit
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            marks = ",".join("?" * len(part))
+            for k, vec in conn.execute(f"SELECT key, vec FROM embeddings WHERE key IN ({marks})", part):
+                found[k] = array("f", vec).tolist()
+        if found:
+            now = time.time()
+            conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, k) for k in found])
+        out = [found.get(k) for k in keys]
+        misses = out.count(None)
+        with self._lock:
+            self.hits += len(texts) - misses
+            self.misses += misses
+        # Lookups happen in the ingest workers; the aggregated counters are
+        # what /api/metrics can see
+        metrics.incr("chunk_embedding_cache_lookups_total", len(texts) - misses, result="hit")
+        metrics.incr("chunk_embedding_cache_lookups_total", misses, result="miss")
+        return out
+
+    def put_many(self, model_name, texts, vectors):
+        if not texts:
+            return
+        now = time.time()
+        rows = [(_key(model_name, t), array("f", v).tobytes(), now) for t, v in zip(texts, vectors)]
+        conn = self._conn()
+        conn.executemany("INSERT OR REPLACE INTO embeddings (key, vec, last_used) VALUES (?, ?, ?)", rows)
+        with self._lock:
+            self._inserted_since_check += len(rows)
+            check = self._inserted_since_check >= _EVICT_CHECK_EVERY
+            if check:
+                self._inserted_since_check = 0
+        if check:
+            self._evict(conn)
+
+    def _evict(self, conn):
+        count = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        excess = count - self.max_entries
+        if excess <= 0:
+            return
+        conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+            (excess,)
+        )
+        with self._lock:
+            self.evictions += excess
+        metrics.incr("chunk_embedding_cache_evictions_total", excess)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            out = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+        try:
+            out["entries"] = self._conn().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        except sqlite3.Error:
+            pass
+        return out
+
+embedding_cache = EmbeddingCache(EMBED_CACHE_PATH, EMBED_CACHE_MAX_ENTRIES) if EMBED_CACHE_ENABLED else None
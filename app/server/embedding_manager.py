@@ -1,50 +1,366 @@
 import os
-from sentence_transformers import SentenceTransformer
+import sys
+import time
+import uuid
+import threading
+from array import array
+from collections import OrderedDict
 import chromadb
+from embedding_cache import embedding_cache
+from embedding_model import EMBED_MODEL_ID, encode_local
+import embedding_service
+import metrics
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-CHROMA_DIR = os.path.join(BASE_DIR, "..", "chroma_db")
+CHROMA_DIR = os.getenv("CHROMA_DIR", os.path.join(BASE_DIR, "..", "chroma_db"))
+# When set, talk to a Chroma server instead of opening CHROMA_DIR in this
+# process. PersistentClient is not safe with several writer processes, so
+# fanned-out ingestion (tasks.INGEST_FANOUT_PAGES) needs this.
+CHROMA_HOST = os.getenv("CHROMA_HOST")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
 
-EMBED_MODEL = SentenceTransformer("all-MiniLM-L6-v2")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+# When set, encodes go to the shared embedding service on this socket and the
+# in-process model is only loaded if the service is unreachable.
+EMBED_SERVICE_SOCKET = os.getenv("EMBED_SERVICE_SOCKET")
+EMBED_SERVICE_RETRY_AFTER = 30.0
+# "per_user": one Chroma collection per user, chunks tagged with their
+# document's collection_id. "per_file": the original one collection per PDF.
+INDEX_LAYOUT = os.getenv("INDEX_LAYOUT", "per_user").lower()
+_service_down_until = 0.0
 
-client = chromadb.PersistentClient(path=CHROMA_DIR)
+try:
+    from gevent import get_hub
+    from gevent.monkey import is_module_patched
+except ImportError:
+    get_hub = None
+
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "4096"))
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+if CHROMA_HOST:
+    client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+else:
+    client = chromadb.PersistentClient(path=CHROMA_DIR)
+
+def _run_blocking(fn, *args, **kwargs):
+    """
+    Under gevent workers, runs CPU-bound calls (model encode, HNSW query) on
+    the hub's native thread pool so other greenlets keep streaming.
+    """
+    if get_hub is not None and is_module_patched("threading"):
+        return get_hub().threadpool.apply(fn, args, kwargs)
+    return fn(*args, **kwargs)
+
+def _encode_batch(texts, batch_size=None):
+    global _service_down_until
+    if EMBED_SERVICE_SOCKET and time.monotonic() >= _service_down_until:
+        try:
+            # Vectors are cached under our EMBED_MODEL_ID, so a service running
+            # another EMBED_BACKEND is treated as unavailable
+            return embedding_service.remote_encode(texts, path=EMBED_SERVICE_SOCKET, model_id=EMBED_MODEL_ID)
+        except (OSError, RuntimeError) as e:
+            print(f"DEBUG: Embedding service unavailable, using in-process model: {e}")
+            _service_down_until = time.monotonic() + EMBED_SERVICE_RETRY_AFTER
+    return encode_local(texts, batch_size=batch_size or EMBED_BATCH_SIZE)
 
 def get_embedding(text):
-    emb = EMBED_MODEL.encode(text)
-    return emb.tolist()
+    return _encode_batch([text])[0]
+
+def get_embeddings(texts, batch_size=None):
+    """
+    Encodes a list of texts in one vectorized call. Texts already in the
+    persistent embedding cache are not re-encoded.
+    """
+    if not texts:
+        return []
+    if embedding_cache is None:
+        return _encode_batch(texts, batch_size)
+
+    try:
+        out = embedding_cache.get_many(EMBED_MODEL_ID, texts)
+    except Exception as e:
+        print(f"DEBUG: Embedding cache read failed: {e}")
+        return _encode_batch(texts, batch_size)
+
+    missing = list(dict.fromkeys(t for t, v in zip(texts, out) if v is None))
+    if missing:
+        encoded = dict(zip(missing, _encode_batch(missing, batch_size)))
+        out = [v if v is not None else encoded[t] for t, v in zip(texts, out)]
+        try:
+            embedding_cache.put_many(EMBED_MODEL_ID, missing, [encoded[t] for t in missing])
+        except Exception as e:
+            print(f"DEBUG: Embedding cache write failed: {e}")
+    return out
+
+class QueryEmbeddingCache:
+    """
+    Process-wide LRU of query embeddings, bounded by entry count and by an
+    estimate of the memory held by the cached vectors.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size(key, vec):
+        # float32 array buffer and header, the query text and the dict slot
+        return sys.getsizeof(vec) + sys.getsizeof(key[1]) + 64
+
+    def get(self, key):
+        with self._lock:
+            vec = self._data.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return vec.tolist()
+
+    def put(self, key, vec):
+        # float32 like the model output, ~4 bytes per dimension instead of
+        # ~32 for a tuple of Python floats
+        vec = array("f", vec)
+        size = self._size(key, vec)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= self._size(key, old)
+            self._data[key] = vec
+            self._bytes += size
+            while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+                k, v = self._data.popitem(last=False)
+                self._bytes -= self._size(k, v)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+query_cache = QueryEmbeddingCache(QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_MAX_BYTES)
+
+def _normalize_query(text):
+    return " ".join((text or "").split())
+
+def get_query_embedding(query):
+    """Cached variant of get_embedding for user queries."""
+    key = (EMBED_MODEL_ID, _normalize_query(query))
+    emb = query_cache.get(key)
+    if emb is None:
+        emb = _run_blocking(get_embedding, key[1])
+        query_cache.put(key, emb)
+    return emb
+
+_collections = {}
+_collections_lock = threading.Lock()
 
 def create_collection(name):
+    """Returns an open handle for `name`, creating the collection if needed."""
+    col = _collections.get(name)
+    if col is not None:
+        return col
+    with _collections_lock:
+        col = _collections.get(name)
+        if col is None:
+            col = client.get_or_create_collection(name=name)
+            _collections[name] = col
+    return col
+
+def invalidate_collection(name):
+    with _collections_lock:
+        _collections.pop(name, None)
+
+def delete_collection(name):
+    invalidate_collection(name)
     try:
-        return client.create_collection(name=name)
-    except Exception:
-        return client.get_collection(name=name)
+        client.delete_collection(name=name)
+    except Exception as e:
+        print(f"DEBUG: Chroma delete for '{name}' failed: {e}")
 
-def upsert_chunks(collection_name, chunks):
+def legacy_collection_name(user_id, filename):
+    return f"user_{user_id}__{filename}"
+
+def user_index_name(user_id):
+    # Legacy per-file names always start with "user_", so these cannot collide
+    return f"docs_user_{user_id}"
+
+def rebuilt_index_name(user_id, token=None):
     """
-    chunks: list of {"text", "meta"}
+    Fresh collection name for a re-index, swapped in when the rebuild
+    finishes. `token` (e.g. the task id) keeps rebuilds started in the same
+    second apart; a random one is used when it is not given.
     """
-    col = create_collection(collection_name)
+    token = (token or uuid.uuid4().hex).replace("-", "")[:12]
+    return f"{user_index_name(user_id)}_r{int(time.time())}_{token}"
+
+def index_for_new_document(user_id, filename, user_index=None):
+    """
+    Chroma collection a newly ingested document is written to. `user_index`
+    is users.index_name, set once the user's documents have been re-indexed.
+    """
+    if INDEX_LAYOUT == "per_file":
+        return legacy_collection_name(user_id, filename)
+    return user_index or user_index_name(user_id)
+
+def _where_ids(ids):
+    return {"collection_id": ids[0]} if len(ids) == 1 else {"collection_id": {"$in": list(ids)}}
+
+def _flush_batch(collection_name, ids, docs, metadatas, batch_size):
+    t0 = time.perf_counter()
+    with metrics.span("ingest_stage_seconds", stage="embed"):
+        embeddings = get_embeddings(docs, batch_size=batch_size)
+    with metrics.span("ingest_stage_seconds", stage="index"):
+        try:
+            create_collection(collection_name).add(ids=ids, documents=docs, metadatas=metadatas, embeddings=embeddings)
+        except Exception:
+            invalidate_collection(collection_name)
+            create_collection(collection_name).add(ids=ids, documents=docs, metadatas=metadatas, embeddings=embeddings)
+    elapsed = time.perf_counter() - t0
+    rate = len(docs) / elapsed if elapsed > 0 else float("inf")
+    print(f"DEBUG: Indexed {len(docs)} chunks in {elapsed:.2f}s ({rate:.1f} chunks/sec, batch_size={batch_size})")
+
+def upsert_chunks(collection_name, chunks, batch_size=None, on_batch=None, id_prefix=None, doc_meta=None):
+    """
+    chunks: iterable of {"text", "meta"}
+
+    Chunks are encoded and written to Chroma one batch at a time, so the
+    input can be a generator and memory stays bounded by the batch size.
+    `doc_meta` is merged into every chunk's metadata and `id_prefix`
+    (default: the collection name) keeps ids unique in a shared index.
+    `on_batch(metadatas)` is called after each batch becomes searchable.
+    Returns throughput stats for tuning EMBED_BATCH_SIZE.
+    """
+    id_prefix = id_prefix or collection_name
+    batch_size = batch_size or EMBED_BATCH_SIZE
     ids = []
     docs = []
     metadatas = []
-    embeddings = []
-    
+    total = 0
+    t0 = time.perf_counter()
+
     for i, c in enumerate(chunks):
-        ids.append(f"{collection_name}-{i}")
+        ids.append(f"{id_prefix}-{i}")
         docs.append(c["text"])
-        metadatas.append(c["meta"])
-        embeddings.append(get_embedding(c["text"]))
-        
-    col.add(ids=ids, documents=docs, metadatas=metadatas, embeddings=embeddings)
+        metadatas.append(dict(c["meta"], **doc_meta) if doc_meta else c["meta"])
+        if len(docs) >= batch_size:
+            _flush_batch(collection_name, ids, docs, metadatas, batch_size)
+            total += len(docs)
+            if on_batch:
+                on_batch(metadatas)
+            ids, docs, metadatas = [], [], []
 
-def semantic_search(collection_name, query, top_k=5):
+    if docs:
+        _flush_batch(collection_name, ids, docs, metadatas, batch_size)
+        total += len(docs)
+        if on_batch:
+            on_batch(metadatas)
+
+    elapsed = time.perf_counter() - t0
+    rate = total / elapsed if elapsed > 0 else 0.0
+    print(f"DEBUG: upsert_chunks '{collection_name}': {total} chunks, {rate:.1f} chunks/sec (batch_size={batch_size})")
+    return {"chunks": total, "seconds": round(elapsed, 3), "chunks_per_sec": round(rate, 1), "batch_size": batch_size}
+
+def copy_documents(src_name, dst_name, where=None, id_prefix=None, doc_meta=None, batch_size=None):
+    """
+    Copies documents, metadata and stored vectors (optionally filtered by
+    `where`) from one collection to another without re-encoding. Returns
+    the number of chunks copied.
+    """
+    batch_size = batch_size or EMBED_BATCH_SIZE * 4
+    id_prefix = id_prefix or dst_name
+    src = create_collection(src_name)
+    dst = create_collection(dst_name)
+    total = 0
+    offset = 0
+    while True:
+        res = src.get(where=where, include=["documents", "metadatas", "embeddings"], limit=batch_size, offset=offset)
+        ids = res["ids"]
+        if not ids:
+            break
+        new_ids = [f"{id_prefix}-{total + i}" for i in range(len(ids))]
+        embeddings = [list(e) for e in res["embeddings"]]
+        metadatas = [dict(m, **doc_meta) for m in res["metadatas"]] if doc_meta else res["metadatas"]
+        dst.add(ids=new_ids, documents=res["documents"], metadatas=metadatas, embeddings=embeddings)
+        total += len(ids)
+        offset += len(ids)
+    return total
+
+def delete_documents(collection_name, collection_ids):
+    """Removes the chunks of the given documents from a shared index."""
+    if collection_ids:
+        create_collection(collection_name).delete(where=_where_ids(collection_ids))
+
+def delete_page_range(collection_name, collection_id, first_page, last_page):
+    """Removes one document's chunks for pages first_page..last_page (inclusive)."""
+    create_collection(collection_name).delete(where={"$and": [
+        {"collection_id": collection_id},
+        {"page": {"$gte": first_page}},
+        {"page": {"$lte": last_page}},
+    ]})
+
+def semantic_search(collection_name, query, top_k=5, where=None):
+    q_emb = get_query_embedding(query)
     col = create_collection(collection_name)
-    q_emb = get_embedding(query)
-    res = col.query(query_embeddings=[q_emb], n_results=top_k, include=["documents","metadatas","distances"])
+    include = ["documents","metadatas","distances"]
+    with metrics.span("chat_stage_seconds", stage="vector_search"):
+        try:
+            res = _run_blocking(col.query, query_embeddings=[q_emb], n_results=top_k, where=where, include=include)
+        except Exception:
+            # The handle may be stale if another process deleted/recreated the collection
+            invalidate_collection(collection_name)
+            col = create_collection(collection_name)
+            res = _run_blocking(col.query, query_embeddings=[q_emb], n_results=top_k, where=where, include=include)
     
     results = []
     if res["documents"]:
         for d, m, dist in zip(res["documents"][0], res["metadatas"][0], res["distances"][0]):
             results.append({"text": d, "meta": m, "score": dist})
             
-    return results
\ No newline at end of file
+    return results
+
+def search_documents(docs, query, top_k=5):
+    """
+    Searches any number of documents with one query per Chroma collection.
+    `docs` are collections rows with id, user_id, filename and index_name
+    (NULL for documents still in a legacy per-file collection).
+    """
+    shared = {}
+    legacy = []
+    for d in docs:
+        if d.get("index_name"):
+            shared.setdefault(d["index_name"], []).append(d["id"])
+        else:
+            legacy.append(d)
+
+    results = []
+    for index_name, ids in shared.items():
+        results += semantic_search(index_name, query, top_k=top_k, where=_where_ids(ids))
+    for d in legacy:
+        for r in semantic_search(legacy_collection_name(d["user_id"], d["filename"]), query, top_k=top_k):
+            r["meta"] = dict(r["meta"] or {}, collection_id=d["id"], filename=d["filename"])
+            results.append(r)
+
+    results.sort(key=lambda r: r["score"])
+    return results[:top_k]
@@ -0,0 +1,50 @@
+import os
+import threading
+import importlib.util
+from sentence_transformers import SentenceTransformer
+
+EMBED_MODEL_NAME = "all-MiniLM-L6-v2"
+# "fp32" (default), "int8" (dynamic int8 quantization of the Linear layers
+# on CPU) or "onnx" (ONNX Runtime, see EMBED_ONNX_FILE)
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "fp32").lower()
+# Quantized ONNX export published alongside the model; pick the variant
+# matching the node's CPU (e.g. model_qint8_avx2.onnx)
+EMBED_ONNX_FILE = os.getenv("EMBED_ONNX_FILE", "onnx/model_qint8_avx512_vnni.onnx")
+
+# Identifies the vectors a backend produces, for cache keys. fp32 keeps the
+# bare model name so existing cache entries stay valid.
+EMBED_MODEL_ID = EMBED_MODEL_NAME if EMBED_BACKEND == "fp32" else f"{EMBED_MODEL_NAME}@{EMBED_BACKEND}"
+
+_model = None
+_model_lock = threading.Lock()
+
+def load_model(backend=EMBED_BACKEND):
+    if backend == "fp32":
+        return SentenceTransformer(EMBED_MODEL_NAME)
+    if backend == "int8":
+        import torch
+        model = SentenceTransformer(EMBED_MODEL_NAME, device="cpu")
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if backend == "onnx":
+        # Optional extra, not in requirements.txt: pip install "sentence-transformers[onnx]"
+        missing = [m for m in ("onnxruntime", "optimum") if importlib.util.find_spec(m) is None]
+        if missing:
+            raise ImportError(
+                f"EMBED_BACKEND=onnx needs {', '.join(missing)}; "
+                "install it with: pip install \"sentence-transformers[onnx]\""
+            )
+        return SentenceTransformer(EMBED_MODEL_NAME, backend="onnx", model_kwargs={"file_name": EMBED_ONNX_FILE})
+    raise ValueError(f"Unknown EMBED_BACKEND '{backend}' (expected fp32, int8 or onnx)")
+
+def get_model():
+    """Loads the configured backend on first use."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = load_model()
+                print(f"DEBUG: Loaded embedding model {EMBED_MODEL_ID}")
+    return _model
+
+def encode_local(texts, batch_size=64):
+    return get_model().encode(texts, batch_size=batch_size).tolist()
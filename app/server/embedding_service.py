@@ -0,0 +1,168 @@
+"""
+Local embedding service shared by the API and Celery processes on a node.
+
+Run with `python embedding_service.py`. Clients connect over a Unix socket
+(EMBED_SERVICE_SOCKET); requests that arrive within EMBED_SERVICE_WINDOW_MS
+of each other are encoded together as one batch, so one model copy serves
+every process and concurrent one-query encodes share a forward pass.
+
+Wire format, both directions: 4-byte big-endian length + JSON body.
+Request {"texts": [...]}, response {"embeddings": [...], "model": EMBED_MODEL_ID}
+or {"error": "..."}. Clients check "model" against their own EMBED_MODEL_ID,
+since every embedding cache is keyed by it.
+"""
+import os
+import json
+import time
+import queue
+import socket
+import struct
+import threading
+import socketserver
+
+EMBED_SERVICE_SOCKET = os.getenv("EMBED_SERVICE_SOCKET", "/tmp/intellidocs-embed.sock")
+EMBED_SERVICE_WINDOW_MS = float(os.getenv("EMBED_SERVICE_WINDOW_MS", "5"))
+EMBED_SERVICE_MAX_BATCH = int(os.getenv("EMBED_SERVICE_MAX_BATCH", "128"))
+EMBED_SERVICE_TIMEOUT = float(os.getenv("EMBED_SERVICE_TIMEOUT", "30"))
+
+_HEADER = struct.Struct(">I")
+
+def _send(sock, obj):
+    body = json.dumps(obj).encode("utf-8")
+    sock.sendall(_HEADER.pack(len(body)) + body)
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        part = sock.recv(n - len(buf))
+        if not part:
+            raise ConnectionError("embedding service connection closed")
+        buf.extend(part)
+    return bytes(buf)
+
+def _recv(sock):
+    (length,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return json.loads(_recv_exact(sock, length))
+
+def remote_encode(texts, path=EMBED_SERVICE_SOCKET, timeout=EMBED_SERVICE_TIMEOUT, model_id=None):
+    """
+    Client side: encodes `texts` through the service. Raises OSError if it
+    is unreachable, RuntimeError if it fails or, given `model_id`, serves a
+    different model or backend.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        _send(sock, {"texts": list(texts)})
+        resp = _recv(sock)
+    if "error" in resp:
+        raise RuntimeError(f"embedding service error: {resp['error']}")
+    if model_id is not None and resp.get("model") != model_id:
+        raise RuntimeError(f"embedding service serves {resp.get('model')!r}, expected {model_id!r}")
+    return resp["embeddings"]
+
+class _Request:
+    __slots__ = ("texts", "done", "result", "error")
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class MicroBatcher:
+    """Coalesces requests that arrive within `window` seconds into one encode call."""
+
+    def __init__(self, encode, window, max_batch):
+        self.encode = encode
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self.batches = 0
+        self.requests = 0
+        threading.Thread(target=self._run, name="embed-batcher", daemon=True).start()
+
+    def submit(self, texts):
+        req = _Request(texts)
+        self._queue.put(req)
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.result
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        size = len(batch[0].texts)
+        deadline = time.monotonic() + self.window
+        while size < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                req = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(req)
+            size += len(req.texts)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [t for req in batch for t in req.texts]
+            try:
+                vectors = self.encode(texts) if texts else []
+                offset = 0
+                for req in batch:
+                    req.result = vectors[offset:offset + len(req.texts)]
+                    offset += len(req.texts)
+            except Exception as e:
+                for req in batch:
+                    req.error = e
+            self.batches += 1
+            self.requests += len(batch)
+            for req in batch:
+                req.done.set()
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                msg = _recv(self.request)
+            except (ConnectionError, OSError):
+                return
+            try:
+                embeddings = self.server.batcher.submit(msg["texts"])
+                _send(self.request, {"embeddings": embeddings, "model": self.server.model_id})
+            except Exception as e:
+                _send(self.request, {"error": str(e)})
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    # Bursts of concurrent queries connect at once; the default backlog is 5
+    request_queue_size = 512
+
+def serve(path=EMBED_SERVICE_SOCKET):
+    from embedding_model import EMBED_MODEL_ID, encode_local
+
+    encode_local(["warm up"])
+    if os.path.exists(path):
+        os.remove(path)
+    server = _Server(path, _Handler)
+    server.model_id = EMBED_MODEL_ID
+    server.batcher = MicroBatcher(
+        lambda texts: encode_local(texts, batch_size=EMBED_SERVICE_MAX_BATCH),
+        EMBED_SERVICE_WINDOW_MS / 1000.0,
+        EMBED_SERVICE_MAX_BATCH
+    )
+    os.chmod(path, 0o666)
+    print(f"Embedding service ({EMBED_MODEL_ID}) listening on {path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,21 @@
+import os
+
+# "sync" keeps one request per worker thread; "async" runs gevent workers so
+# long chat streams, LLM calls and web searches yield instead of blocking.
+SERVER_MODE = os.getenv("SERVER_MODE", "sync").lower()
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+
+if SERVER_MODE == "async":
+    worker_class = "gevent"
+    # Concurrent requests (open chat streams) held per worker process
+    worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+    # Streams are long-lived; this only bounds a worker that stops heartbeating
+    timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+
+def post_fork(server, worker):
+    if SERVER_MODE == "async":
+        # psycopg2 is a C extension; make its socket waits cooperative too
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
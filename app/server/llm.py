@@ -1,16 +1,35 @@
 import os 
+import time
 import textwrap
+import threading
 import google.generativeai as genai
+from context_packer import pack_context
+import metrics
 
 KEY = os.getenv("GEMINI_API_KEY")
 print(f"DEBUG: Gemini API Key found? {'Yes' if KEY else 'No'}")
 
+# Under gevent the default gRPC transport would block the event loop while
+# streaming, so async mode talks to Gemini over REST (patched sockets).
+SERVER_MODE = os.getenv("SERVER_MODE", "sync").lower()
+
 if KEY:
     try:
-        genai.configure(api_key=KEY)
+        genai.configure(api_key=KEY, transport="rest" if SERVER_MODE == "async" else None)
     except Exception as e:
         print(f"DEBUG: Gemini configuration failed: {e}")
 
+# Set GEMINI_MODEL to skip model discovery entirely
+GEMINI_MODEL = os.getenv("GEMINI_MODEL")
+GEMINI_MODEL_TTL = float(os.getenv("GEMINI_MODEL_TTL", "3600"))
+
+_model_lock = threading.Lock()
+_model_cache = {"name": None, "model": None, "resolved_at": 0.0, "discovery_failed": False}
+# After a failed discovery, retry sooner than the full TTL
+_MODEL_RETRY_AFTER = 60.0
+
+ALL_MODELS_FAILED = "DEBUG: All AI models failed. Please check server logs."
+
 _OLLAMA_AVAILABLE = False
 try:
     import ollama
@@ -40,9 +59,9 @@ def generate_search_query(user_query: str) -> str:
     
     if KEY:
         try:
-            model_name = _get_working_model()
-            model = genai.GenerativeModel(model_name)
-            response = model.generate_content(prompt)
+            model = _get_model()
+            with metrics.span("chat_stage_seconds", stage="query_rewrite"):
+                response = model.generate_content(prompt)
             return response.text.strip()
         except Exception as e:
             print(f"DEBUG: Query rewrite failed: {e}")
@@ -50,17 +69,16 @@ def generate_search_query(user_query: str) -> str:
     return user_query
 
 def _format_prompt(query: str, pdf_chunks: list, web_sources: list | None, mode: str) -> str:
-    MAX_CHUNKS = 10             
-    MAX_CHARS_PER_CHUNK = 1500   
     MAX_USER_BLOCK = 20000      
 
+    spans = pack_context(pdf_chunks)
+    # Name the file only when the context spans several documents
+    multi_doc = len({s["filename"] for s in spans}) > 1
     chunk_blocks = []
-    for i, ch in enumerate(pdf_chunks[:MAX_CHUNKS], 1):
-        meta = ch.get("meta") or {}
-        page = meta.get("page", "?")
-        text = (ch.get("text") or "").strip()
-        if text:
-            chunk_blocks.append(f"[Page {page}]:\n{text}")
+    for s in spans:
+        page = s["page"] if s["page"] is not None else "?"
+        label = f"[Page {page}] ({s['filename']})" if multi_doc and s["filename"] else f"[Page {page}]"
+        chunk_blocks.append(f"{label}:\n{s['text']}")
 
     chunks_joined = "\n\n".join(chunk_blocks) if chunk_blocks else "[No relevant PDF text found]"
 
@@ -93,10 +111,13 @@ def _format_prompt(query: str, pdf_chunks: list, web_sources: list | None, mode:
     {web_block}
     """).strip()
 
+    # The document context is already budgeted; this only guards against
+    # a pathological query or web block.
     return f"{system}\n\n{_truncate_tokens(user, MAX_USER_BLOCK)}"
 
 def _get_working_model():
     if not KEY: return None
+    if GEMINI_MODEL: return GEMINI_MODEL
     try:
         available_models = []
         for m in genai.list_models():
@@ -111,15 +132,43 @@ def _get_working_model():
             
     except Exception as e:
         print(f"DEBUG: Failed to list models: {e}")
+        _model_cache["discovery_failed"] = True
     return "gemini-pro" 
 
+def _get_model():
+    """
+    Returns a GenerativeModel shared by the whole process. Model discovery
+    runs at most once per GEMINI_MODEL_TTL seconds.
+    """
+    now = time.monotonic()
+    cached = _model_cache["model"]
+    if cached is not None and now - _model_cache["resolved_at"] < GEMINI_MODEL_TTL:
+        return cached
+    with _model_lock:
+        if _model_cache["model"] is not None and now - _model_cache["resolved_at"] < GEMINI_MODEL_TTL:
+            return _model_cache["model"]
+        _model_cache["discovery_failed"] = False
+        model_name = _get_working_model()
+        if _model_cache["model"] is None or model_name != _model_cache["name"]:
+            print(f"DEBUG: Using Gemini model '{model_name}'")
+            _model_cache["model"] = genai.GenerativeModel(model_name)
+            _model_cache["name"] = model_name
+        _model_cache["resolved_at"] = now
+        if _model_cache["discovery_failed"]:
+            _model_cache["resolved_at"] -= max(GEMINI_MODEL_TTL - _MODEL_RETRY_AFTER, 0)
+        return _model_cache["model"]
+
+def reset_model_cache():
+    with _model_lock:
+        _model_cache.update({"name": None, "model": None, "resolved_at": 0.0, "discovery_failed": False})
+
 def generate_answer_stream(query: str, pdf_chunks: list, web_sources: list | None, mode: str = "discrete"):
-    prompt = _format_prompt(query, pdf_chunks, web_sources, mode)
+    with metrics.span("chat_stage_seconds", stage="prompt_build"):
+        prompt = _format_prompt(query, pdf_chunks, web_sources, mode)
 
     if KEY:
         try:
-            model_name = _get_working_model()
-            model = genai.GenerativeModel(model_name)
+            model = _get_model()
             response = model.generate_content(prompt, stream=True)
             for chunk in response:
                 if chunk.text:
@@ -141,4 +190,4 @@ def generate_answer_stream(query: str, pdf_chunks: list, web_sources: list | Non
         except Exception:
             pass
 
-    yield "DEBUG: All AI models failed. Please check server logs."
\ No newline at end of file
+    yield ALL_MODELS_FAILED
\ No newline at end of file
@@ -0,0 +1,227 @@
+"""
+Latency histograms for the chat and ingestion pipelines.
+
+Code records a stage with
+
+    with metrics.span("chat_stage_seconds", stage="vector_search"):
+        ...
+
+Observations are aggregated in-process and merged into Redis every
+METRICS_FLUSH_INTERVAL seconds. Gunicorn workers and Celery workers
+therefore all feed one set of histograms, and /api/metrics serves them
+in the Prometheus text format. If Redis is unreachable the endpoint
+falls back to this process's own numbers.
+"""
+import os
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+import redis
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+# Print one JSON line per span, for ad-hoc tracing of a single request
+METRICS_LOG_SPANS = os.getenv("METRICS_LOG_SPANS", "0") == "1"
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+HELP = {
+    "chat_stage_seconds": "Latency of each stage of a /api/chat request",
+    "ingest_stage_seconds": "Latency of each stage of PDF ingestion",
+    "chunk_embedding_cache_lookups_total": "Chunk embedding cache lookups by result (hit or miss)",
+    "chunk_embedding_cache_evictions_total": "Chunk embeddings evicted from the persistent cache",
+}
+
+_KEY_PREFIX = "metrics"
+_SERIES_KEY = f"{_KEY_PREFIX}:series"
+# Hash of counter series (JSON [metric, labels]) -> total
+_COUNTERS_KEY = f"{_KEY_PREFIX}:counters"
+_REDIS_RETRY_AFTER = 30.0
+
+_lock = threading.Lock()
+# (metric, labels tuple) -> [bucket counts..., sum, count], not yet flushed
+_pending = {}
+# Same shape, everything this process ever recorded (fallback when Redis is down)
+_local = {}
+# Counters: (metric, labels tuple) -> increment, same pending/local split
+_pending_counts = {}
+_local_counts = {}
+_last_flush = time.monotonic()
+_redis = None
+_redis_down_until = 0.0
+
+def _client():
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+    return _redis
+
+def _empty():
+    return [0] * len(BUCKETS) + [0.0, 0]
+
+def _add(store, key, seconds):
+    row = store.get(key)
+    if row is None:
+        row = store[key] = _empty()
+    for i, le in enumerate(BUCKETS):
+        if seconds <= le:
+            row[i] += 1
+            break
+    row[-2] += seconds
+    row[-1] += 1
+
+def observe(metric, seconds, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = (metric, tuple(sorted(labels.items())))
+    with _lock:
+        _add(_pending, key, seconds)
+        _add(_local, key, seconds)
+        due = time.monotonic() - _last_flush >= METRICS_FLUSH_INTERVAL
+    if METRICS_LOG_SPANS:
+        print(json.dumps({"span": metric, **labels, "seconds": round(seconds, 6)}))
+    if due:
+        flush()
+
+def incr(metric, amount=1, **labels):
+    """Adds to a counter summed across every process, like the histograms."""
+    if not METRICS_ENABLED or not amount:
+        return
+    key = (metric, tuple(sorted(labels.items())))
+    with _lock:
+        _pending_counts[key] = _pending_counts.get(key, 0) + amount
+        _local_counts[key] = _local_counts.get(key, 0) + amount
+        due = time.monotonic() - _last_flush >= METRICS_FLUSH_INTERVAL
+    if due:
+        flush()
+
+@contextmanager
+def span(metric, **labels):
+    """Times the block and records it, whether or not it raised."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(metric, time.perf_counter() - t0, **labels)
+
+def _series_key(metric, labels):
+    return f"{_KEY_PREFIX}:{metric}:" + json.dumps(labels, separators=(",", ":"))
+
+def flush():
+    """Merges pending observations into Redis; on failure they are kept for the next attempt."""
+    global _pending, _pending_counts, _last_flush, _redis_down_until
+    with _lock:
+        pending, _pending = _pending, {}
+        counts, _pending_counts = _pending_counts, {}
+        _last_flush = time.monotonic()
+    if not pending and not counts:
+        return
+    if time.monotonic() < _redis_down_until:
+        _requeue(pending, counts)
+        return
+    try:
+        pipe = _client().pipeline(transaction=False)
+        for (metric, labels), row in pending.items():
+            key = _series_key(metric, labels)
+            pipe.sadd(_SERIES_KEY, key)
+            for le, n in zip(BUCKETS, row):
+                if n:
+                    pipe.hincrby(key, str(le), n)
+            pipe.hincrbyfloat(key, "sum", row[-2])
+            pipe.hincrby(key, "count", row[-1])
+        for (metric, labels), n in counts.items():
+            pipe.hincrby(_COUNTERS_KEY, json.dumps([metric, labels], separators=(",", ":")), n)
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f"DEBUG: Metrics flush failed: {e}")
+        _redis_down_until = time.monotonic() + _REDIS_RETRY_AFTER
+        _requeue(pending, counts)
+
+def _requeue(pending, counts):
+    with _lock:
+        for key, row in pending.items():
+            cur = _pending.setdefault(key, _empty())
+            for i, v in enumerate(row):
+                cur[i] += v
+        for key, n in counts.items():
+            _pending_counts[key] = _pending_counts.get(key, 0) + n
+
+atexit.register(flush)
+
+def _collect():
+    """
+    Returns ({(metric, labels): row}, {(metric, labels): total}) for
+    histograms and counters across all processes, or this process only
+    without Redis.
+    """
+    flush()
+    try:
+        if time.monotonic() < _redis_down_until:
+            raise redis.ConnectionError("backing off after a failed flush")
+        client = _client()
+        keys = sorted(k.decode() for k in client.smembers(_SERIES_KEY))
+        pipe = client.pipeline(transaction=False)
+        for k in keys:
+            pipe.hgetall(k)
+        pipe.hgetall(_COUNTERS_KEY)
+        *rows, raw_counts = pipe.execute()
+        out = {}
+        for k, fields in zip(keys, rows):
+            metric, _, labels = k[len(_KEY_PREFIX) + 1:].partition(":")
+            fields = {f.decode(): v.decode() for f, v in fields.items()}
+            row = [int(fields.get(str(le), 0)) for le in BUCKETS]
+            row += [float(fields.get("sum", 0.0)), int(fields.get("count", 0))]
+            out[(metric, tuple(tuple(p) for p in json.loads(labels)))] = row
+        counts = {}
+        for field, n in raw_counts.items():
+            metric, labels = json.loads(field)
+            counts[(metric, tuple(tuple(p) for p in labels))] = int(n)
+        return out, counts
+    except redis.RedisError as e:
+        print(f"DEBUG: Metrics read failed, serving local histograms: {e}")
+        with _lock:
+            return {k: list(v) for k, v in _local.items()}, dict(_local_counts)
+
+def _fmt_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{str(v)}"' for k, v in pairs)
+    return "{" + body + "}"
+
+def render(gauges=None):
+    """
+    Prometheus text exposition (version 0.0.4) of every histogram and
+    counter, followed by `gauges`: (metric, help, labels, value) tuples for
+    point-in-time values of the process serving the scrape, such as cache
+    sizes.
+    """
+    series, counts = _collect()
+    lines = []
+    for metric in sorted({m for m, _ in series}):
+        lines.append(f"# HELP {metric} {HELP.get(metric, metric)}")
+        lines.append(f"# TYPE {metric} histogram")
+        for (m, labels), row in sorted(series.items()):
+            if m != metric:
+                continue
+            cumulative = 0
+            for le, n in zip(BUCKETS, row):
+                cumulative += n
+                lines.append(f"{metric}_bucket{_fmt_labels(labels, ('le', le))} {cumulative}")
+            lines.append(f"{metric}_bucket{_fmt_labels(labels, ('le', '+Inf'))} {row[-1]}")
+            lines.append(f"{metric}_sum{_fmt_labels(labels)} {row[-2]:.6f}")
+            lines.append(f"{metric}_count{_fmt_labels(labels)} {row[-1]}")
+    for metric in sorted({m for m, _ in counts}):
+        lines.append(f"# HELP {metric} {HELP.get(metric, metric)}")
+        lines.append(f"# TYPE {metric} counter")
+        for (m, labels), n in sorted(counts.items()):
+            if m == metric:
+                lines.append(f"{metric}{_fmt_labels(labels)} {n}")
+    for metric, help_text, labels, value in gauges or ():
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric}{_fmt_labels(sorted(labels.items()))} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,91 @@
+"""
+Moves documents from the legacy one-collection-per-file layout into the
+per-user shared index (docs_user_{id}), copying stored vectors rather
+than re-embedding.
+
+    python migrate_index.py                 # every legacy document
+    python migrate_index.py --user 42       # one user
+    python migrate_index.py --dry-run       # report only
+
+Safe to re-run: a document's chunks are cleared from the user index before
+being copied, and rows are only switched over once the copy succeeded.
+"""
+import sys
+import argparse
+from dotenv import load_dotenv
+load_dotenv()
+from database import get_conn
+from models import find_user_by_id
+import answer_cache
+from embedding_manager import (
+    copy_documents, delete_documents, legacy_collection_name, user_index_name,
+    delete_collection as delete_chroma_collection
+)
+
+def legacy_documents(user_id=None):
+    with get_conn() as conn:
+        cur = conn.cursor()
+        if user_id is None:
+            cur.execute("SELECT id, user_id, filename FROM collections WHERE index_name IS NULL ORDER BY id")
+        else:
+            cur.execute(
+                "SELECT id, user_id, filename FROM collections WHERE index_name IS NULL AND user_id = %s ORDER BY id",
+                (user_id,)
+            )
+        return cur.fetchall()
+
+def _still_referenced(user_id, filename):
+    """Legacy collections are keyed by filename, so re-uploads may share one."""
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT 1 FROM collections WHERE user_id = %s AND filename = %s AND index_name IS NULL LIMIT 1",
+            (user_id, filename)
+        )
+        return cur.fetchone() is not None
+
+def migrate_document(row):
+    cid, uid, filename = row["id"], row["user_id"], row["filename"]
+    legacy = legacy_collection_name(uid, filename)
+    user = find_user_by_id(uid)
+    index_name = (user and user["index_name"]) or user_index_name(uid)
+
+    delete_documents(index_name, [cid])
+    copied = copy_documents(
+        legacy, index_name, id_prefix=str(cid),
+        doc_meta={"collection_id": cid, "filename": filename}
+    )
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE collections SET index_name = %s WHERE id = %s", (index_name, cid))
+        conn.commit()
+
+    if not _still_referenced(uid, filename):
+        delete_chroma_collection(legacy)
+    answer_cache.invalidate_document(uid, filename)
+    return copied, index_name
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user", type=int, default=None)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+
+    rows = legacy_documents(args.user)
+    print(f"{len(rows)} document(s) in the legacy layout")
+    failed = 0
+    for row in rows:
+        label = f"#{row['id']} user {row['user_id']} {row['filename']!r}"
+        if args.dry_run:
+            print(f"would migrate {label}")
+            continue
+        try:
+            copied, index_name = migrate_document(row)
+            print(f"migrated {label}: {copied} chunks -> {index_name}")
+        except Exception as e:
+            failed += 1
+            print(f"FAILED {label}: {e}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,34 +1,93 @@
+import os
+import json
+import time
+import base64
+import threading
+from collections import OrderedDict
+from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from database import get_conn
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# A PDF viewer fetches a document as many byte ranges, so the ownership
+# lookup behind each download request is cached briefly per process. Rows
+# never change owner, filename or path, but forget_collection_file only
+# reaches the worker that served the DELETE: other workers may keep
+# serving a deleted document, or a re-upload stored at the same path, for
+# up to this many seconds. Keep it to roughly one viewer session's burst.
+DOWNLOAD_LOOKUP_TTL = float(os.getenv("DOWNLOAD_LOOKUP_TTL", "5"))
+DOWNLOAD_LOOKUP_MAX_ENTRIES = 1024
+_file_lookups = OrderedDict()
+_file_lookups_lock = threading.Lock()
+
+def _page_size(limit):
+    try:
+        limit = int(limit) if limit is not None else DEFAULT_PAGE_SIZE
+    except (TypeError, ValueError):
+        limit = DEFAULT_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+def encode_cursor(created_at, row_id):
+    """Opaque keyset cursor for listings ordered by (created_at DESC, id DESC)."""
+    raw = json.dumps([created_at.isoformat(), row_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    """Raises ValueError for cursors not produced by encode_cursor."""
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+def _keyset_page(table, columns, filters, limit, cursor):
+    """
+    Fetches one page of `table` newest first. `filters` is a list of
+    (sql, value) pairs ANDed together. Returns (rows, next_cursor).
+    """
+    limit = _page_size(limit)
+    clauses = [f for f, _ in filters]
+    params = [v for _, v in filters]
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        clauses.append("(created_at, id) < (%s, %s)")
+        params += [created_at, row_id]
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"SELECT {columns} FROM {table} WHERE {' AND '.join(clauses)} "
+            "ORDER BY created_at DESC, id DESC LIMIT %s",
+            params + [limit + 1]
+        )
+        rows = cur.fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]["created_at"], rows[limit - 1]["id"]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
 def create_user(username, email, password):
     pw_hash = generate_password_hash(password)
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO users (username, email, password_hash) VALUES (%s, %s, %s) RETURNING id",
-        (username, email, pw_hash)
-    )
-    last = cur.fetchone()['id']
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO users (username, email, password_hash) VALUES (%s, %s, %s) RETURNING id",
+            (username, email, pw_hash)
+        )
+        last = cur.fetchone()['id']
+        conn.commit()
     return last
 
 def find_user_by_username(username):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE username = %s", (username,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM users WHERE username = %s", (username,))
+        return cur.fetchone()
 
 def find_user_by_id(user_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM users WHERE id = %s", (user_id,))
+        return cur.fetchone()
 
 def verify_user(username, password):
     user = find_user_by_username(username)
@@ -39,70 +98,106 @@ def verify_user(username, password):
     return None
 
 def create_collection_entry(user_id, filename, stored_path):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO collections (user_id, filename, stored_path, processing_status) VALUES (%s, %s, %s, 'pending') RETURNING id",
-        (user_id, filename, stored_path)
-    )
-    cid = cur.fetchone()['id']
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO collections (user_id, filename, stored_path, processing_status) VALUES (%s, %s, %s, 'pending') RETURNING id",
+            (user_id, filename, stored_path)
+        )
+        cid = cur.fetchone()['id']
+        conn.commit()
     return cid
 
-def list_collections_for_user(user_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM collections WHERE user_id = %s ORDER BY created_at DESC", (user_id,))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+def list_collections_for_user(user_id, limit=None, cursor=None, filename=None):
+    filters = [("user_id = %s", user_id)]
+    if filename is not None:
+        filters.append(("filename = %s", filename))
+    return _keyset_page(
+        "collections", "id, filename, processing_status, pages_done, pages_total, created_at",
+        filters, limit, cursor
+    )
 
 def find_collection_by_id(collection_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM collections WHERE id = %s", (collection_id,))
-    row = cur.fetchone()
-    conn.close()
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM collections WHERE id = %s", (collection_id,))
+        return cur.fetchone()
+
+def get_collection_file(collection_id):
+    """Returns {"user_id", "filename", "stored_path"} for a collection, or None."""
+    now = time.monotonic()
+    with _file_lookups_lock:
+        hit = _file_lookups.get(collection_id)
+        if hit and now - hit[0] < DOWNLOAD_LOOKUP_TTL:
+            _file_lookups.move_to_end(collection_id)
+            return hit[1]
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT user_id, filename, stored_path FROM collections WHERE id = %s", (collection_id,))
+        row = cur.fetchone()
+    row = dict(row) if row else None
+    if row:
+        with _file_lookups_lock:
+            _file_lookups[collection_id] = (now, row)
+            _file_lookups.move_to_end(collection_id)
+            while len(_file_lookups) > DOWNLOAD_LOOKUP_MAX_ENTRIES:
+                _file_lookups.popitem(last=False)
     return row
 
+def forget_collection_file(collection_id):
+    with _file_lookups_lock:
+        _file_lookups.pop(collection_id, None)
+
 def create_chat(user_id, name=None, collection_id=None, mode="discrete"):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO chats (user_id, name, collection_id, mode) VALUES (%s, %s, %s, %s) RETURNING id",
-        (user_id, name, collection_id, mode)
-    )
-    cid = cur.fetchone()['id']
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO chats (user_id, name, collection_id, mode) VALUES (%s, %s, %s, %s) RETURNING id",
+            (user_id, name, collection_id, mode)
+        )
+        cid = cur.fetchone()['id']
+        conn.commit()
     return cid
 
-def list_chats_for_user(user_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM chats WHERE user_id = %s ORDER BY created_at DESC", (user_id,))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+def list_chats_for_user(user_id, limit=None, cursor=None, name=None):
+    filters = [("user_id = %s", user_id)]
+    if name is not None:
+        filters.append(("name = %s", name))
+    return _keyset_page("chats", "id, name, collection_id, mode, created_at", filters, limit, cursor)
 
 def add_memory(user_id, chat_id, role, content):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO memories (user_id, chat_id, role, content) VALUES (%s, %s, %s, %s)",
-        (user_id, chat_id, role, content)
-    )
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO memories (user_id, chat_id, role, content) VALUES (%s, %s, %s, %s)",
+            (user_id, chat_id, role, content)
+        )
+        conn.commit()
 
 def get_recent_memories(user_id, chat_id, limit=8):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT role, content, created_at FROM memories WHERE user_id = %s AND chat_id = %s ORDER BY id DESC LIMIT %s",
-        (user_id, chat_id, limit)
-    )
-    rows = cur.fetchall()
-    conn.close()
-    return list(reversed(rows))
\ No newline at end of file
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT role, content, created_at FROM memories WHERE user_id = %s AND chat_id = %s ORDER BY id DESC LIMIT %s",
+            (user_id, chat_id, limit)
+        )
+        rows = cur.fetchall()
+    return list(reversed(rows))
+
+def get_memories_page(user_id, chat_id, limit=None, before=None):
+    """
+    Returns (rows oldest-first, next_cursor) for the newest `limit` memories
+    older than memory id `before`; next_cursor pages further back.
+    """
+    limit = _page_size(limit)
+    sql = "SELECT id, role, content FROM memories WHERE chat_id = %s AND user_id = %s"
+    params = [chat_id, user_id]
+    if before:
+        sql += " AND id < %s"
+        params.append(int(before))
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(sql + " ORDER BY id DESC LIMIT %s", params + [limit + 1])
+        rows = cur.fetchall()
+    next_cursor = str(rows[limit - 1]["id"]) if len(rows) > limit else None
+    return list(reversed(rows[:limit])), next_cursor
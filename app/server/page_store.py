@@ -0,0 +1,96 @@
+"""
+Keeps the extracted text of every page next to its upload, so documents
+can be re-chunked or re-embedded without running PyMuPDF and Tesseract
+again.
+
+The store for `<upload>.pdf` is the directory `<upload>.pdf.pages/`, with
+one gzip-compressed JSON-lines part per ingested page range, for example
+`000001-000050.jsonl.gz`. A monolithic ingest writes a single part and a
+fanned-out ingest writes one part per range. Parts are written to a
+temporary file and renamed into place only once the whole range has been
+read, so a part that exists is always complete.
+"""
+import os
+import re
+import json
+import gzip
+import shutil
+
+PAGE_STORE_ENABLED = os.getenv("PAGE_STORE_ENABLED", "1") == "1"
+_PART_RE = re.compile(r"^(\d{6})-(\d{6})\.jsonl\.gz$")
+
+def store_dir(pdf_path):
+    return pdf_path + ".pages"
+
+def clear(pdf_path):
+    """Drops stored pages, e.g. because the upload at this path was replaced."""
+    shutil.rmtree(store_dir(pdf_path), ignore_errors=True)
+
+def _parts(pdf_path):
+    try:
+        names = os.listdir(store_dir(pdf_path))
+    except FileNotFoundError:
+        return []
+    parts = []
+    for name in names:
+        m = _PART_RE.match(name)
+        if m:
+            parts.append((int(m.group(1)), int(m.group(2)), os.path.join(store_dir(pdf_path), name)))
+    return sorted(parts)
+
+def is_complete(pdf_path, pages_total):
+    """True when stored parts cover pages 1..pages_total without gaps."""
+    if not pages_total:
+        return False
+    expected = 1
+    for first, last, _ in _parts(pdf_path):
+        if first > expected:
+            return False
+        expected = max(expected, last + 1)
+    return expected > pages_total
+
+def iter_stored_pages(pdf_path):
+    """Yields {"page", "text"} in page order, the same shape as pdf_parser.iter_pages."""
+    seen = 0
+    for _, _, path in _parts(pdf_path):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                page = json.loads(line)
+                # Overlapping parts (a re-run range) may repeat pages
+                if page["page"] > seen:
+                    seen = page["page"]
+                    yield page
+
+def record(pdf_path, pages, first_page=1):
+    """
+    Passes `pages` through unchanged while writing them to the store. The
+    part only becomes visible if the iterator is consumed to the end.
+    """
+    if not PAGE_STORE_ENABLED:
+        yield from pages
+        return
+    directory = store_dir(pdf_path)
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, f".{first_page:06d}.{os.getpid()}.tmp")
+    last_page = first_page - 1
+    done = False
+    try:
+        with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=6) as f:
+            for page in pages:
+                f.write(json.dumps(page, ensure_ascii=False, separators=(",", ":")) + "\n")
+                last_page = page["page"]
+                yield page
+        if last_page >= first_page:
+            os.replace(tmp_path, os.path.join(directory, f"{first_page:06d}-{last_page:06d}.jsonl.gz"))
+            done = True
+    finally:
+        if not done and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def copy(src_pdf_path, dst_pdf_path):
+    """Copies a store to another upload with identical content (dedup clones)."""
+    if not os.path.isdir(store_dir(src_pdf_path)) or src_pdf_path == dst_pdf_path:
+        return False
+    clear(dst_pdf_path)
+    shutil.copytree(store_dir(src_pdf_path), store_dir(dst_pdf_path), ignore=shutil.ignore_patterns("*.tmp"))
+    return True
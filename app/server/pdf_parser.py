@@ -1,45 +1,195 @@
 import fitz 
 import pytesseract 
-from PIL import Image
-import io 
 import os 
-def extract_text_from_pdf(path, ocr_if_needed=True, dpi=150):
+import math
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import metrics
 
-    pages = []
+# Max concurrent Tesseract processes per worker; 1 disables parallel OCR
+PDF_OCR_WORKERS = int(os.getenv("PDF_OCR_WORKERS", str(min(4, os.cpu_count() or 1))))
+# A page with some text is still OCR'd when images cover this much of it and
+# its text layer is short, e.g. a scan with a stamped header or page number.
+OCR_IMAGE_COVERAGE = float(os.getenv("OCR_IMAGE_COVERAGE", "0.6"))
+OCR_MAX_TEXT_CHARS = int(os.getenv("OCR_MAX_TEXT_CHARS", "200"))
+# Render resolution is picked so a page comes out at about this many pixels,
+# within [OCR_MIN_DPI, OCR_MAX_DPI]: ~200 dpi for Letter/A4, more for small pages.
+OCR_TARGET_PIXELS = int(os.getenv("OCR_TARGET_PIXELS", "4000000"))
+OCR_MIN_DPI = int(os.getenv("OCR_MIN_DPI", "100"))
+OCR_MAX_DPI = int(os.getenv("OCR_MAX_DPI", "300"))
+# Seconds before tesseract is killed and the page falls back to its text layer
+OCR_PAGE_TIMEOUT = float(os.getenv("OCR_PAGE_TIMEOUT", "60"))
+
+def _ocr_dpi(page):
+    area_in = (page.rect.width / 72) * (page.rect.height / 72)
+    if area_in <= 0:
+        return OCR_MAX_DPI
+    dpi = math.sqrt(OCR_TARGET_PIXELS / area_in)
+    return int(min(OCR_MAX_DPI, max(OCR_MIN_DPI, dpi)))
+
+def _render_page(page, dpi=None):
+    """
+    Renders a page to a temporary grayscale PGM and returns its path.
+    Tesseract reads the file directly, so the pixels are never copied into
+    a PIL image or re-encoded as PNG, and the pixmap is freed right away.
+    """
+    pix = page.get_pixmap(dpi=dpi or _ocr_dpi(page), colorspace=fitz.csGRAY, alpha=False)
+    fd, path = tempfile.mkstemp(prefix="ocr_", suffix=".pgm")
+    os.close(fd)
+    try:
+        pix.save(path)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+def _ocr_image(path, fallback=""):
+    """OCRs a rendered page file and deletes it. Returns `fallback` on failure, timeout or empty output."""
+    try:
+        with metrics.span("ingest_stage_seconds", stage="ocr"):
+            text = pytesseract.image_to_string(path, timeout=OCR_PAGE_TIMEOUT)
+    except pytesseract.TesseractError as e:
+        # Subclass of RuntimeError, so it must be caught before the timeout case
+        print(f"DEBUG: OCR failed on a page (tesseract exit {e.status}): {e.message}")
+        text = ""
+    except RuntimeError as e:
+        # pytesseract raises RuntimeError after killing tesseract at the timeout
+        print(f"DEBUG: OCR gave up on a page after {OCR_PAGE_TIMEOUT}s: {e}")
+        text = ""
+    finally:
+        os.remove(path)
+    return text.strip() or fallback
+
+def _union_area(rects):
+    """Area covered by `rects`, counting overlaps once (strips between x edges)."""
+    xs = sorted({x for r in rects for x in (r.x0, r.x1)})
+    covered = 0.0
+    for x0, x1 in zip(xs, xs[1:]):
+        spans = sorted((r.y0, r.y1) for r in rects if r.x0 <= x0 and r.x1 >= x1)
+        height, top, bottom = 0.0, None, None
+        for y0, y1 in spans:
+            if top is None or y0 > bottom:
+                if top is not None:
+                    height += bottom - top
+                top, bottom = y0, y1
+            else:
+                bottom = max(bottom, y1)
+        if top is not None:
+            height += bottom - top
+        covered += (x1 - x0) * height
+    return covered
+
+def _image_coverage(page):
+    area = page.rect.get_area()
+    if not area:
+        return 0.0
+    rects = [fitz.Rect(info["bbox"]) & page.rect for info in page.get_image_info()]
+    # Layered scans often stack several images on one area; don't double count
+    covered = _union_area([r for r in rects if not r.is_empty])
+    return min(1.0, covered / area)
+
+def _needs_ocr(page, text):
+    if not text:
+        return True
+    if len(text) >= OCR_MAX_TEXT_CHARS:
+        return False
+    return _image_coverage(page) >= OCR_IMAGE_COVERAGE
+
+def _iter_pages(path, ocr_if_needed, dpi, ocr_workers, first_page, last_page):
+    """
+    Yields pages in order. Text extraction and rendering stay on the calling
+    thread (PyMuPDF is not thread-safe); OCR runs in a thread pool where each
+    call is its own tesseract process, so up to `ocr_workers` pages are OCR'd
+    at once while at most 2x that many rendered pages wait in temp files.
+    """
     doc = fitz.open(path)
-    for i in range(len(doc)):
-        page = doc.load_page(i)
-        txt = page.get_text("text").strip()
-        if not txt and ocr_if_needed:
-            pix = page.get_pixmap(dpi=dpi)
-            mode = "RGB" if pix.n < 4 else "RGBA"
-            img = Image.frombytes(mode, [pix.width, pix.height], pix.samples)
-            ocr_text = pytesseract.image_to_string(img)
-            pages.append({"page": i+1, "text": ocr_text})
-        else:
-            pages.append({"page": i+1, "text": txt})
-    doc.close()
-    return pages
-def chunk_pages(pages, chunk_size=1000, overlap=200):
+    pool = ThreadPoolExecutor(max_workers=ocr_workers) if ocr_workers > 1 else None
+    pending = deque()
+    last_page = len(doc) if last_page is None else min(last_page, len(doc))
+    try:
+        for i in range(first_page - 1, last_page):
+            page = doc.load_page(i)
+            with metrics.span("ingest_stage_seconds", stage="extract"):
+                txt = page.get_text("text").strip()
+            if ocr_if_needed and _needs_ocr(page, txt):
+                with metrics.span("ingest_stage_seconds", stage="render"):
+                    image_path = _render_page(page, dpi)
+                if pool is None:
+                    pending.append((i + 1, _ocr_image(image_path, txt), None))
+                else:
+                    pending.append((i + 1, pool.submit(_ocr_image, image_path, txt), image_path))
+            else:
+                pending.append((i + 1, txt, None))
+
+            while pending and (len(pending) > 2 * ocr_workers or isinstance(pending[0][1], str)):
+                num, res, _ = pending.popleft()
+                yield {"page": num, "text": res if isinstance(res, str) else res.result()}
 
-    chunks = []
+        while pending:
+            num, res, _ = pending.popleft()
+            yield {"page": num, "text": res if isinstance(res, str) else res.result()}
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+            # Cancelled OCR jobs never ran, so their page images are still on disk
+            for _, res, image_path in pending:
+                if image_path and res.cancelled():
+                    os.remove(image_path)
+        doc.close()
+
+def iter_pages(path, ocr_if_needed=True, dpi=None, ocr_workers=None, first_page=1, last_page=None):
+    """
+    Generator form of extract_text_from_pdf: yields {"page", "text"} in order.
+    `first_page`/`last_page` (1-based, inclusive) restrict it to a page range.
+    `dpi` fixes the OCR render resolution; by default it follows page size.
+    """
+    workers = PDF_OCR_WORKERS if ocr_workers is None else max(1, ocr_workers)
+    if workers > 1:
+        # Parallel tesseract processes should not each spawn a full set of OpenMP threads
+        os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    return _iter_pages(path, ocr_if_needed, dpi, workers, max(1, first_page), last_page)
+
+def extract_text_from_pdf(path, ocr_if_needed=True, dpi=None, ocr_workers=None):
+    return list(iter_pages(path, ocr_if_needed, dpi, ocr_workers))
+
+def count_pages(path):
+    with fitz.open(path) as doc:
+        return len(doc)
+
+def ocr_page_numbers(path):
+    """Pages (1-based) that iter_pages would send to OCR; reads only the text layer."""
+    with fitz.open(path) as doc:
+        return [i + 1 for i, page in enumerate(doc) if _needs_ocr(page, page.get_text("text").strip())]
+
+def _chunk_page(p, chunk_size, overlap):
+    text = p.get("text", "") or ""
+    length = len(text)
+    if length == 0:
+        return [{"text": "", "meta": {"page": p["page"], "start": 0, "end": 0}}]
+    out = []
+    start = 0
+    while start < length:
+        end = min(length, start + chunk_size)
+        chunk_text = text[start:end].strip()
+        if chunk_text:
+            meta = {"page": p["page"], "start": start, "end": end}
+            out.append({"text": chunk_text, "meta": meta})
+        start = end - overlap
+        if start < 0:
+            start = 0
+        if end == length:
+            break
+    return out
+
+def iter_chunks(pages, chunk_size=1000, overlap=200):
+    """Generator form of chunk_pages; consumes `pages` lazily."""
     for p in pages:
-        text = p.get("text", "") or ""
-        start = 0
-        length = len(text)
-        if length == 0:
-            chunks.append({"text": "", "meta": {"page": p["page"], "start": 0, "end": 0}})
-            continue
-        while start < length:
-            end = min(length, start + chunk_size)
-            chunk_text = text[start:end].strip()
-            if chunk_text:
-                meta = {"page": p["page"], "start": start, "end": end}
-                chunks.append({"text": chunk_text, "meta": meta})
-            start = end - overlap
-            if start < 0:
-                start = 0
-            if end == length:
-                break
-    return chunks
+        # A page at a time, so the span excludes whatever the consumer does between chunks
+        with metrics.span("ingest_stage_seconds", stage="chunk"):
+            chunks = _chunk_page(p, chunk_size, overlap)
+        yield from chunks
+
+def chunk_pages(pages, chunk_size=1000, overlap=200):
+    return list(iter_chunks(pages, chunk_size, overlap))
         
\ No newline at end of file
@@ -1,23 +1,76 @@
-from embedding_manager import semantic_search
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from embedding_manager import search_documents
 # Import the new function
 from llm import generate_answer_stream, generate_search_query 
 from web_search import web_search
+import metrics
 
-def run_agent(query, collection_name, mode="discrete", top_k=5):
+# Per-stage deadlines (seconds) for hybrid mode
+RETRIEVAL_TIMEOUT = float(os.getenv("RETRIEVAL_TIMEOUT", "10"))
+REWRITE_TIMEOUT = float(os.getenv("REWRITE_TIMEOUT", "3"))
+WEB_TIMEOUT = float(os.getenv("WEB_TIMEOUT", "6"))
+# What to do when the web branch misses WEB_TIMEOUT: "skip" answers from the
+# PDF alone, "wait" blocks until web results arrive
+HYBRID_WEB_FALLBACK = os.getenv("HYBRID_WEB_FALLBACK", "skip").lower()
 
-    retrieved = semantic_search(collection_name, query, top_k=top_k)
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("RAG_STAGE_WORKERS", "16")), thread_name_prefix="rag")
+# Rewrites are submitted from tasks already running on _executor, so they get
+# their own pool: nesting into _executor can deadlock once every worker is an
+# outer task waiting on a rewrite. A rewrite that misses its deadline keeps
+# running here without holding a stage worker.
+_rewrite_executor = ThreadPoolExecutor(max_workers=int(os.getenv("RAG_REWRITE_WORKERS", "4")), thread_name_prefix="rag-rewrite")
 
-    web_sources = []
+def _rewrite_and_search(query):
+    rewrite = _rewrite_executor.submit(generate_search_query, query)
+    try:
+        optimized_query = rewrite.result(timeout=REWRITE_TIMEOUT)
+        print(f"DEBUG: Rewrote '{query}' -> '{optimized_query}'")
+    except FutureTimeout:
+        print(f"DEBUG: Query rewrite missed {REWRITE_TIMEOUT}s deadline, searching raw query")
+        optimized_query = query
+    with metrics.span("chat_stage_seconds", stage="web_search"):
+        return web_search(optimized_query, top_k=3)
+
+def _remaining(deadline):
+    return max(0.0, deadline - time.monotonic())
+
+def _web_sources(future, deadline):
+    """`deadline` is a time.monotonic() value taken when the branch was submitted."""
+    try:
+        if HYBRID_WEB_FALLBACK == "wait":
+            return future.result()
+        return future.result(timeout=_remaining(deadline))
+    except FutureTimeout:
+        print(f"DEBUG: Web search missed {WEB_TIMEOUT}s deadline, answering without web sources")
+    except Exception as e:
+        print(f"DEBUG: Web search pipeline failed: {e}")
+    return []
+
+def run_agent(query, docs, mode="discrete", top_k=5):
+    """`docs` are the collections rows (one or many) to retrieve from."""
+
+    web_future = None
     if mode.lower() == "hybrid":
+        # Retrieval and the rewrite -> search chain are independent, so the
+        # slower of the two bounds latency instead of their sum. Both
+        # deadlines run from submission, not from when we start waiting.
+        started = time.monotonic()
+        web_future = _executor.submit(_rewrite_and_search, query)
+        retrieval = _executor.submit(search_documents, docs, query, top_k=top_k)
         try:
+            retrieved = retrieval.result(timeout=_remaining(started + RETRIEVAL_TIMEOUT))
+        except FutureTimeout:
+            # Answer from the web branch alone; a query already running in
+            # Chroma can't be interrupted, so its result is just dropped.
+            retrieval.cancel()
+            print(f"DEBUG: Retrieval missed {RETRIEVAL_TIMEOUT}s deadline, answering without PDF context")
+            retrieved = []
+    else:
+        retrieved = search_documents(docs, query, top_k=top_k)
 
-            optimized_query = generate_search_query(query)
-            print(f"DEBUG: Rewrote '{query}' -> '{optimized_query}'")
-            
-            web_sources = web_search(optimized_query, top_k=3)
-        except Exception as e:
-            print(f"DEBUG: Web search pipeline failed: {e}")
-            web_sources = []
+    web_sources = _web_sources(web_future, started + WEB_TIMEOUT) if web_future else []
 
     pdf_sources = []
     for item in retrieved:
@@ -26,6 +79,8 @@ def run_agent(query, collection_name, mode="discrete", top_k=5):
         pdf_sources.append({
             "type": "pdf",
             "page": meta.get("page"),
+            "filename": meta.get("filename"),
+            "collection_id": meta.get("collection_id"),
             "snippet": text[:200]
         })
 
@@ -0,0 +1,43 @@
+"""
+Queues background re-index jobs that rebuild users' vector indexes from
+stored page text (no PDF parsing or OCR when the page store is complete),
+e.g. after changing CHUNK_SIZE/CHUNK_OVERLAP or EMBED_BACKEND.
+
+    python reindex.py --user 42
+    python reindex.py --all
+    python reindex.py --user 42 --inline    # run in this process instead of a worker
+
+Searches keep hitting the current index until a rebuild finishes, then
+switch over in one transaction.
+"""
+import sys
+import argparse
+from dotenv import load_dotenv
+load_dotenv()
+from database import get_conn
+from tasks import reindex_user_task
+
+def users_with_documents():
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT DISTINCT user_id FROM collections WHERE processing_status = 'completed' ORDER BY user_id")
+        return [r["user_id"] for r in cur.fetchall()]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--user", type=int)
+    target.add_argument("--all", action="store_true")
+    parser.add_argument("--inline", action="store_true", help="run the rebuild here rather than on a Celery worker")
+    args = parser.parse_args(argv)
+
+    user_ids = users_with_documents() if args.all else [args.user]
+    for uid in user_ids:
+        if args.inline:
+            print(reindex_user_task.apply(args=(uid,)).get())
+        else:
+            print(f"queued re-index of user {uid}: task {reindex_user_task.delay(uid).id}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
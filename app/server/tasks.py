@@ -1,10 +1,19 @@
 import os
+import time
 from dotenv import load_dotenv
 load_dotenv()
-from celery import Celery
+from celery import Celery, chord
 from database import get_conn
-from pdf_parser import extract_text_from_pdf, chunk_pages
-from embedding_manager import upsert_chunks, create_collection as create_chroma_collection
+from models import find_user_by_id
+from pdf_parser import iter_pages, iter_chunks, count_pages, ocr_page_numbers
+import answer_cache
+import metrics
+import page_store
+from embedding_manager import (
+    upsert_chunks, copy_documents, delete_documents, delete_page_range, index_for_new_document,
+    legacy_collection_name, rebuilt_index_name, CHROMA_HOST, create_collection as create_chroma_collection,
+    delete_collection as delete_chroma_collection
+)
 
 celery = Celery(
     'tasks', 
@@ -12,36 +21,331 @@ celery = Celery(
     backend=os.getenv('REDIS_URL', 'redis://redis:6379/0')
 )
 
+# Changing these only affects new uploads until the documents are re-indexed
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1000"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "200"))
+
+# Documents with more pages than this are split into page ranges that run
+# as parallel subtasks; 0 disables fan-out. Range tasks in different worker
+# processes write to the index at once, so fan-out only happens against a
+# Chroma server (CHROMA_HOST); with a local CHROMA_DIR documents are
+# ingested by a single task.
+INGEST_FANOUT_PAGES = int(os.getenv("INGEST_FANOUT_PAGES", "100"))
+INGEST_RANGE_PAGES = int(os.getenv("INGEST_RANGE_PAGES", "50"))
+INGEST_RANGE_RETRIES = int(os.getenv("INGEST_RANGE_RETRIES", "3"))
+# Ranges containing scanned pages go to the OCR queue so OCR-heavy and
+# text-only workers can be sized separately. Both default to Celery's
+# default queue, which a plain `celery worker` consumes.
+INGEST_TEXT_QUEUE = os.getenv("INGEST_TEXT_QUEUE", "celery")
+INGEST_OCR_QUEUE = os.getenv("INGEST_OCR_QUEUE", "celery")
+
+def _set_progress(collection_id, status, pages_done=None, pages_total=None):
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """UPDATE collections
+               SET processing_status = %s,
+                   pages_done = COALESCE(%s, pages_done),
+                   pages_total = COALESCE(%s, pages_total)
+               WHERE id = %s""",
+            (status, pages_done, pages_total, collection_id)
+        )
+        conn.commit()
+
+def _add_pages_done(collection_id, first_page, last_page):
+    """Counts a finished page range once, however often its task ran."""
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """UPDATE collections
+               SET pages_done = LEAST(pages_done + %s, COALESCE(pages_total, pages_done + %s)),
+                   ranges_done = array_append(ranges_done, %s),
+                   processing_status = CASE WHEN processing_status = 'failed' THEN 'failed' ELSE 'partial' END
+               WHERE id = %s AND NOT (%s = ANY(ranges_done))""",
+            (last_page - first_page + 1, last_page - first_page + 1, first_page, collection_id, first_page)
+        )
+        conn.commit()
+
+def _prepare_index(collection_id, user_id, filename):
+    """
+    Picks the Chroma collection for a document, records it on the row and
+    clears any chunks left by an earlier attempt. Returns the index name.
+    """
+    user = find_user_by_id(user_id)
+    index_name = index_for_new_document(user_id, filename, user and user["index_name"])
+    shared = index_name != legacy_collection_name(user_id, filename)
+    if shared:
+        delete_documents(index_name, [collection_id])
+    else:
+        delete_chroma_collection(index_name)
+    create_chroma_collection(index_name)
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """UPDATE collections SET index_name = %s, ingest_generation = ingest_generation + 1
+               WHERE id = %s""",
+            (index_name if shared else None, collection_id)
+        )
+        conn.commit()
+    answer_cache.invalidate_document(user_id, filename)
+    return index_name
+
 @celery.task(bind=True)
 def process_pdf_task(self, file_path, filename, user_id, collection_id):
+    t0 = time.perf_counter()
     try:
         print(f"Processing PDF: {filename} for User {user_id}")
         
-        pages = extract_text_from_pdf(file_path, ocr_if_needed=True)
-        chunks = chunk_pages(pages, chunk_size=1000, overlap=200)
-        
-        collection_name = f"user_{user_id}__{filename}"
-        create_chroma_collection(collection_name)
-        upsert_chunks(collection_name, chunks)
-        
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute(
-            "UPDATE collections SET processing_status = 'completed' WHERE id = %s",
-            (collection_id,)
+        pages_total = count_pages(file_path)
+        # The file at this path may have been replaced; its old page text is stale
+        page_store.clear(file_path)
+        _set_progress(collection_id, 'processing', pages_done=0, pages_total=pages_total)
+        self.update_state(state="PROGRESS", meta={"pages_done": 0, "pages_total": pages_total})
+
+        index_name = _prepare_index(collection_id, user_id, filename)
+
+        if INGEST_FANOUT_PAGES and pages_total > INGEST_FANOUT_PAGES and CHROMA_HOST:
+            parts = _fan_out(file_path, filename, user_id, collection_id, index_name, pages_total)
+            return {"status": "fanned_out", "collection_id": collection_id, "parts": parts}
+
+        # Pages flow through chunking and embedding lazily; each indexed batch
+        # makes its pages searchable before the rest of the document is parsed.
+        def on_batch(metadatas):
+            pages_done = max(m["page"] for m in metadatas)
+            _set_progress(collection_id, 'partial', pages_done=pages_done)
+            self.update_state(state="PROGRESS", meta={"pages_done": pages_done, "pages_total": pages_total})
+
+        pages = page_store.record(file_path, iter_pages(file_path, ocr_if_needed=True))
+        chunks = iter_chunks(pages, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP)
+        upsert_chunks(
+            index_name, chunks, on_batch=on_batch,
+            id_prefix=str(collection_id), doc_meta={"collection_id": collection_id, "filename": filename}
         )
-        conn.commit()
-        conn.close()
+        
+        _set_progress(collection_id, 'completed', pages_done=pages_total)
+        # Answers given while the document was only partially indexed are stale now
+        answer_cache.invalidate_document(user_id, filename)
+        metrics.observe("ingest_stage_seconds", time.perf_counter() - t0, stage="total")
         return {"status": "success", "collection_id": collection_id}
 
     except Exception as e:
         print(f"Error processing PDF: {e}")
-        conn = get_conn()
+        _set_progress(collection_id, 'failed')
+        raise e
+    finally:
+        # Workers can sit idle for a long time; don't hold this document's spans until the next one
+        metrics.flush()
+
+def _page_ranges(pages_total, size):
+    return [(first, min(first + size - 1, pages_total)) for first in range(1, pages_total + 1, size)]
+
+def _fan_out(file_path, filename, user_id, collection_id, index_name, pages_total):
+    """
+    Schedules one process_page_range task per page range and a chord
+    callback that completes the document once every range has succeeded.
+    """
+    ocr_pages = set(ocr_page_numbers(file_path))
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE collections SET ranges_done = '{}' WHERE id = %s", (collection_id,))
+        conn.commit()
+    header = []
+    for first, last in _page_ranges(pages_total, INGEST_RANGE_PAGES):
+        needs_ocr = any(first <= p <= last for p in ocr_pages)
+        header.append(
+            process_page_range.s(file_path, filename, collection_id, index_name, first, last)
+            .set(queue=INGEST_OCR_QUEUE if needs_ocr else INGEST_TEXT_QUEUE)
+        )
+    callback = finalize_ingest_task.si(filename, user_id, collection_id, pages_total, time.time())
+    chord(header)(callback.on_error(ingest_failed_task.s(collection_id)))
+    print(f"Split {filename} ({pages_total} pages) into {len(header)} ranges, {len(ocr_pages)} pages need OCR")
+    return len(header)
+
+@celery.task(bind=True, autoretry_for=(Exception,), max_retries=INGEST_RANGE_RETRIES, retry_backoff=True)
+def process_page_range(self, file_path, filename, collection_id, index_name, first_page, last_page):
+    """
+    Indexes pages first_page..last_page of a document. Safe to retry: the
+    range's chunks are cleared first and chunk ids are derived from the
+    range, so a retried range never duplicates or disturbs other ranges.
+    """
+    delete_page_range(index_name, collection_id, first_page, last_page)
+    pages = page_store.record(
+        file_path, iter_pages(file_path, ocr_if_needed=True, first_page=first_page, last_page=last_page), first_page
+    )
+    chunks = iter_chunks(pages, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP)
+    try:
+        upsert_chunks(
+            index_name, chunks, id_prefix=f"{collection_id}-p{first_page}",
+            doc_meta={"collection_id": collection_id, "filename": filename}
+        )
+    finally:
+        metrics.flush()
+    _add_pages_done(collection_id, first_page, last_page)
+    return {"first_page": first_page, "last_page": last_page}
+
+@celery.task
+def finalize_ingest_task(filename, user_id, collection_id, pages_total, started_at):
+    """Chord callback: runs only after every page range succeeded."""
+    _set_progress(collection_id, 'completed', pages_done=pages_total)
+    answer_cache.invalidate_document(user_id, filename)
+    metrics.observe("ingest_stage_seconds", time.time() - started_at, stage="total")
+    metrics.flush()
+    return {"status": "success", "collection_id": collection_id}
+
+@celery.task
+def ingest_failed_task(request, exc, traceback, collection_id):
+    """Chord error callback: a page range exhausted its retries."""
+    print(f"Error processing PDF (collection {collection_id}): range task {request.id} failed: {exc}")
+    _set_progress(collection_id, 'failed')
+
+@celery.task(bind=True)
+def clone_collection_task(self, source_collection_id, file_path, filename, user_id, collection_id):
+    """Indexes a duplicate upload by copying the vectors of an identical, already processed PDF."""
+    try:
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT id, user_id, filename, stored_path, index_name, pages_total FROM collections WHERE id = %s",
+                (source_collection_id,)
+            )
+            source = cur.fetchone()
+        if not source:
+            raise Exception(f"source collection {source_collection_id} is gone")
+
+        print(f"Reusing collection {source['id']} for duplicate upload {filename} (User {user_id})")
+        _set_progress(collection_id, 'processing', pages_done=0, pages_total=source['pages_total'])
+        index_name = _prepare_index(collection_id, user_id, filename)
+        if source['index_name']:
+            src_name, where = source['index_name'], {"collection_id": source['id']}
+        else:
+            src_name, where = legacy_collection_name(source['user_id'], source['filename']), None
+        copied = copy_documents(
+            src_name, index_name, where=where,
+            id_prefix=str(collection_id), doc_meta={"collection_id": collection_id, "filename": filename}
+        )
+    except Exception as e:
+        print(f"Clone failed, processing from scratch: {e}")
+        copied = 0
+
+    if not copied:
+        process_pdf_task.delay(file_path, filename, user_id, collection_id)
+        return {"status": "requeued", "collection_id": collection_id}
+
+    try:
+        if source['stored_path'] == file_path:
+            # An older revision at this path: its store was replaced by the
+            # newer upload's pages, which don't match these bytes
+            page_store.clear(file_path)
+        else:
+            page_store.copy(source['stored_path'], file_path)
+    except OSError as e:
+        print(f"Could not copy stored pages of collection {source['id']}: {e}")
+    _set_progress(collection_id, 'completed', pages_done=source['pages_total'])
+    return {"status": "success", "collection_id": collection_id, "reused": source['id']}
+
+def _reindex_pages(row):
+    """
+    Page text for a re-index: the page store when complete, otherwise parse
+    (and store) the PDF. None when neither is available.
+    """
+    path = row['stored_path']
+    if page_store.is_complete(path, row['pages_total']):
+        return page_store.iter_stored_pages(path)
+    if not os.path.exists(path):
+        return None
+    print(f"No complete page store for collection {row['id']}, parsing {row['filename']}")
+    page_store.clear(path)
+    return page_store.record(path, iter_pages(path, ocr_if_needed=True))
+
+def _drop_if_unreferenced(user_id, row):
+    """Deletes a document's previous Chroma collection once no row points at it."""
+    with get_conn() as conn:
+        cur = conn.cursor()
+        if row['index_name']:
+            name = row['index_name']
+            cur.execute("SELECT 1 FROM collections WHERE index_name = %s LIMIT 1", (name,))
+        else:
+            name = legacy_collection_name(user_id, row['filename'])
+            cur.execute(
+                "SELECT 1 FROM collections WHERE user_id = %s AND filename = %s AND index_name IS NULL LIMIT 1",
+                (user_id, row['filename'])
+            )
+        if cur.fetchone():
+            return False
+    delete_chroma_collection(name)
+    return True
+
+@celery.task(bind=True)
+def reindex_user_task(self, user_id):
+    """
+    Rebuilds all of a user's completed documents into a new Chroma
+    collection using the current CHUNK_SIZE/CHUNK_OVERLAP and embedding
+    model, from stored page text where available. Searches keep using the
+    old index until a single transaction points the user and the rebuilt
+    rows at the new one. Documents uploaded or re-processed meanwhile keep
+    their own index and are not touched.
+    """
+    t0 = time.perf_counter()
+    with get_conn() as conn:
         cur = conn.cursor()
         cur.execute(
-            "UPDATE collections SET processing_status = 'failed' WHERE id = %s",
-            (collection_id,)
+            """SELECT id, filename, stored_path, index_name, pages_total, ingest_generation
+               FROM collections
+               WHERE user_id = %s AND processing_status = 'completed' ORDER BY id""",
+            (user_id,)
         )
+        rows = cur.fetchall()
+
+    new_index = rebuilt_index_name(user_id, self.request.id)
+    create_chroma_collection(new_index)
+    print(f"Re-indexing {len(rows)} document(s) of user {user_id} into {new_index}")
+    built = []
+    try:
+        for done, row in enumerate(rows, 1):
+            pages = _reindex_pages(row)
+            if pages is None:
+                print(f"Skipping collection {row['id']}: neither stored pages nor the PDF are available")
+                continue
+            chunks = iter_chunks(pages, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP)
+            upsert_chunks(
+                new_index, chunks, id_prefix=str(row['id']),
+                doc_meta={"collection_id": row['id'], "filename": row['filename']}
+            )
+            built.append(row)
+            self.update_state(state="PROGRESS", meta={"documents_done": done, "documents_total": len(rows)})
+    except Exception:
+        delete_chroma_collection(new_index)
+        raise
+    finally:
+        metrics.flush()
+
+    with get_conn() as conn:
+        cur = conn.cursor()
+        # Rows deleted or re-processed during the rebuild are left alone: a
+        # re-ingest bumps ingest_generation even if it has completed again
+        cur.execute(
+            """UPDATE collections c SET index_name = %s
+               FROM unnest(%s::int[], %s::int[]) AS b(id, generation)
+               WHERE c.id = b.id AND c.ingest_generation = b.generation
+                 AND c.processing_status = 'completed'
+               RETURNING c.id""",
+            (new_index, [r['id'] for r in built], [r['ingest_generation'] for r in built])
+        )
+        swapped = {r['id'] for r in cur.fetchall()}
+        cur.execute("UPDATE users SET index_name = %s WHERE id = %s", (new_index, user_id))
         conn.commit()
-        conn.close()
-        raise e
\ No newline at end of file
+
+    stale = [r['id'] for r in built if r['id'] not in swapped]
+    if stale:
+        delete_documents(new_index, stale)
+    dropped = set()
+    for row in built:
+        if row['id'] in swapped:
+            answer_cache.invalidate_document(user_id, row['filename'])
+            key = row['index_name'] or legacy_collection_name(user_id, row['filename'])
+            if key not in dropped and _drop_if_unreferenced(user_id, row):
+                dropped.add(key)
+
+    metrics.observe("ingest_stage_seconds", time.perf_counter() - t0, stage="reindex")
+    metrics.flush()
+    return {"status": "success", "user_id": user_id, "index_name": new_index, "documents": len(swapped)}
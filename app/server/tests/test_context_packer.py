@@ -0,0 +1,70 @@
+from context_packer import (
+    CHARS_PER_TOKEN, MIN_PARTIAL_TOKENS, estimate_tokens, merge_spans, drop_near_duplicates, pack_context
+)
+
+PAGE = " ".join(f"word{i:03d}" for i in range(200))
+
+
+def chunk(start, end, page=1, collection_id=1, text=None):
+    return {
+        "text": PAGE[start:end] if text is None else text,
+        "meta": {"collection_id": collection_id, "filename": "a.pdf", "page": page, "start": start, "end": end},
+    }
+
+
+def test_overlapping_chunks_merge_into_one_span():
+    spans = merge_spans([chunk(160, 400), chunk(0, 240)])
+
+    assert len(spans) == 1
+    assert spans[0]["text"] == PAGE[0:400].strip()
+    assert (spans[0]["start"], spans[0]["end"]) == (0, 400)
+    # The merged span keeps the better rank of its members
+    assert spans[0]["rank"] == 0
+
+
+def test_separate_pages_and_gaps_stay_apart_in_rank_order():
+    spans = merge_spans([chunk(500, 600), chunk(0, 100), chunk(0, 100, page=2)])
+
+    assert [(s["page"], s["start"]) for s in spans] == [(1, 500), (1, 0), (2, 0)]
+
+
+def test_chunks_without_offsets_are_kept_individually():
+    chunks = [{"text": "alpha beta", "meta": {"page": 1}}, {"text": "gamma delta", "meta": {"page": 1}}]
+    assert [s["text"] for s in merge_spans(chunks)] == ["alpha beta", "gamma delta"]
+
+
+def test_near_duplicate_keeps_the_better_ranked_copy():
+    spans = merge_spans([chunk(0, 400, collection_id=1), chunk(0, 400, collection_id=2), chunk(800, 1200)])
+    kept = drop_near_duplicates(spans)
+
+    assert len(kept) == 2
+    assert kept[0]["rank"] == 0 and kept[1]["start"] == 800
+
+
+def test_pack_context_respects_token_budget():
+    chunks = [chunk(i * 250, i * 250 + 240, page=i) for i in range(6)]
+    budget = 150
+    packed = pack_context(chunks, token_budget=budget)
+
+    assert sum(estimate_tokens(s["text"]) for s in packed) <= budget + 1
+    assert [s["page"] for s in packed] == list(range(len(packed)))
+
+
+def test_pack_context_truncates_last_span_on_a_word_boundary():
+    long_text = " ".join(["lorem"] * 400)
+    budget = 60 + MIN_PARTIAL_TOKENS
+    packed = pack_context([chunk(0, 240), chunk(0, len(long_text), page=2, text=long_text)], token_budget=budget)
+
+    assert len(packed) == 2
+    tail = packed[1]["text"]
+    assert tail.endswith(" …")
+    assert tail[:-2].split(" ")[-1] == "lorem"
+    assert len(tail) <= (budget - estimate_tokens(packed[0]["text"])) * CHARS_PER_TOKEN + 2
+
+
+def test_pack_context_skips_span_when_headroom_is_too_small():
+    big = chunk(0, 240)
+    budget = estimate_tokens(big["text"]) + MIN_PARTIAL_TOKENS - 1
+    packed = pack_context([big, chunk(500, 1500, page=2)], token_budget=budget)
+
+    assert [s["page"] for s in packed] == [1]
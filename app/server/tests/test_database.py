@@ -0,0 +1,89 @@
+import threading
+import time
+import pytest
+
+pytest.importorskip("psycopg2")
+import database
+from database import ConnectionPool
+
+
+class FakeConn:
+    def __init__(self):
+        self.closed = 0
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def connect(monkeypatch):
+    made = []
+
+    def fake_connect():
+        conn = FakeConn()
+        made.append(conn)
+        return conn
+
+    monkeypatch.setattr(database, "_connect", fake_connect)
+    return made
+
+
+def test_exhausted_pool_times_out(connect):
+    pool = ConnectionPool(minconn=0, maxconn=2, timeout=0.05)
+    pool.acquire()
+    pool.acquire()
+    with pytest.raises(Exception, match="Timed out"):
+        pool.acquire()
+    stats = pool.stats()
+    assert stats["in_use"] == 2
+    assert stats["timeouts"] == 1
+    assert len(connect) == 2
+
+
+def test_release_hands_connection_to_waiter(connect):
+    pool = ConnectionPool(minconn=0, maxconn=1, timeout=2)
+    first = pool.acquire()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.acquire()))
+    waiter.start()
+    time.sleep(0.05)
+    pool.release(first)
+    waiter.join(1)
+
+    assert got == [first]
+    assert first.rollbacks == 1
+    assert len(connect) == 1
+    assert pool.stats()["waits"] >= 1
+
+
+def test_released_connection_is_reused(connect):
+    pool = ConnectionPool(minconn=1, maxconn=3, timeout=0.05)
+    conn = pool.acquire()
+    pool.release(conn)
+    assert pool.acquire() is conn
+    assert pool.stats()["created"] == 1
+
+
+def test_closed_connection_is_discarded_on_release(connect):
+    pool = ConnectionPool(minconn=0, maxconn=1, timeout=0.05)
+    conn = pool.acquire()
+    conn.closed = 1
+    pool.release(conn)
+    stats = pool.stats()
+    assert stats["idle"] == 0 and stats["in_use"] == 0 and stats["closed"] == 1
+    assert pool.acquire() is not conn
+
+
+def test_failed_connect_frees_the_slot(monkeypatch):
+    def broken():
+        raise RuntimeError("db down")
+
+    monkeypatch.setattr(database, "_connect", broken)
+    pool = ConnectionPool(minconn=0, maxconn=1, timeout=0.05)
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+    assert pool.stats()["in_use"] == 0
@@ -0,0 +1,94 @@
+import os
+import tempfile
+import threading
+import time
+import pytest
+
+from embedding_service import MicroBatcher, _Server, _Handler, remote_encode
+
+
+class RecordingEncoder:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(t))] for t in texts]
+
+
+def _submit_all(batcher, requests):
+    results = [None] * len(requests)
+
+    def run(i, texts):
+        results[i] = batcher.submit(texts)
+
+    threads = [threading.Thread(target=run, args=(i, t)) for i, t in enumerate(requests)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    return results
+
+
+def test_flushes_when_batch_is_full():
+    encode = RecordingEncoder()
+    # A window far longer than the test: only the size limit can flush
+    batcher = MicroBatcher(encode, window=30, max_batch=4)
+    t0 = time.monotonic()
+    results = _submit_all(batcher, [["a", "bb"], ["ccc", "dddd"]])
+
+    assert time.monotonic() - t0 < 5
+    assert len(encode.calls) == 1 and sorted(encode.calls[0]) == ["a", "bb", "ccc", "dddd"]
+    assert sorted(results) == [[[1.0], [2.0]], [[3.0], [4.0]]]
+    assert batcher.batches == 1 and batcher.requests == 2
+
+
+def test_flushes_partial_batch_after_window():
+    encode = RecordingEncoder()
+    batcher = MicroBatcher(encode, window=0.05, max_batch=100)
+    t0 = time.monotonic()
+    assert batcher.submit(["abc"]) == [[3.0]]
+    elapsed = time.monotonic() - t0
+
+    assert 0.04 <= elapsed < 2
+    assert encode.calls == [["abc"]]
+
+
+def test_requests_in_one_window_share_a_batch():
+    encode = RecordingEncoder()
+    batcher = MicroBatcher(encode, window=0.5, max_batch=100)
+    results = _submit_all(batcher, [["a"], ["bb"], ["ccc"]])
+
+    assert len(encode.calls) == 1
+    assert sorted(results) == [[[1.0]], [[2.0]], [[3.0]]]
+
+
+def test_encode_error_reaches_every_request_in_the_batch():
+    def broken(texts):
+        raise RuntimeError("model exploded")
+
+    batcher = MicroBatcher(broken, window=0.01, max_batch=10)
+    with pytest.raises(RuntimeError, match="model exploded"):
+        batcher.submit(["x"])
+    # The batcher thread survives and keeps serving
+    with pytest.raises(RuntimeError):
+        batcher.submit(["y"])
+
+
+@pytest.fixture
+def service():
+    path = os.path.join(tempfile.mkdtemp(prefix="embed"), "s.sock")
+    server = _Server(path, _Handler)
+    server.batcher = MicroBatcher(RecordingEncoder(), window=0.001, max_batch=16)
+    server.model_id = "all-MiniLM-L6-v2@int8"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield path
+    server.shutdown()
+    server.server_close()
+    os.remove(path)
+
+
+def test_remote_encode_checks_model_id(service):
+    assert remote_encode(["ab"], path=service, model_id="all-MiniLM-L6-v2@int8") == [[2.0]]
+    with pytest.raises(RuntimeError, match="serves"):
+        remote_encode(["ab"], path=service, model_id="all-MiniLM-L6-v2")
@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("google.generativeai")
+pytest.importorskip("redis")
+import llm
+
+
+class FakeGenai:
+    def __init__(self, names):
+        self.names = names
+        self.list_calls = 0
+        self.fail = False
+
+    def list_models(self):
+        self.list_calls += 1
+        if self.fail:
+            raise RuntimeError("discovery down")
+        return [SimpleNamespace(name=n, supported_generation_methods=["generateContent"]) for n in self.names]
+
+    def GenerativeModel(self, name):
+        return SimpleNamespace(name=name)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def genai(monkeypatch):
+    fake = FakeGenai(["models/gemini-1.5-pro", "models/gemini-1.5-flash"])
+    clock = Clock()
+    monkeypatch.setattr(llm, "genai", fake)
+    monkeypatch.setattr(llm, "time", clock)
+    monkeypatch.setattr(llm, "KEY", "test-key")
+    monkeypatch.setattr(llm, "GEMINI_MODEL", None)
+    monkeypatch.setattr(llm, "GEMINI_MODEL_TTL", 3600.0)
+    llm.reset_model_cache()
+    yield fake, clock
+    llm.reset_model_cache()
+
+
+def test_discovery_runs_once_per_ttl(genai):
+    fake, clock = genai
+    first = llm._get_model()
+    clock.now += 3599
+    assert llm._get_model() is first
+    assert first.name == "models/gemini-1.5-flash"
+    assert fake.list_calls == 1
+
+    clock.now += 2
+    assert llm._get_model() is first
+    assert fake.list_calls == 2
+
+
+def test_ttl_refresh_picks_up_a_new_model(genai):
+    fake, clock = genai
+    assert llm._get_model().name == "models/gemini-1.5-flash"
+    fake.names = ["models/gemini-1.5-pro"]
+    clock.now += 3601
+    assert llm._get_model().name == "models/gemini-1.5-pro"
+
+
+def test_gemini_model_override_skips_discovery(genai, monkeypatch):
+    fake, _ = genai
+    monkeypatch.setattr(llm, "GEMINI_MODEL", "gemini-custom")
+    assert llm._get_model().name == "gemini-custom"
+    assert fake.list_calls == 0
+
+
+def test_failed_discovery_is_retried_before_the_ttl(genai):
+    fake, clock = genai
+    fake.fail = True
+    assert llm._get_model().name == "gemini-pro"
+    clock.now += 30
+    llm._get_model()
+    assert fake.list_calls == 1
+
+    fake.fail = False
+    clock.now += llm._MODEL_RETRY_AFTER
+    assert llm._get_model().name == "models/gemini-1.5-flash"
+    assert fake.list_calls == 2
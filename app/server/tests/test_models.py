@@ -0,0 +1,97 @@
+import base64
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("werkzeug")
+import models
+from models import encode_cursor, decode_cursor
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+
+    def execute(self, sql, params):
+        self.executed.append((sql, params))
+
+    def fetchall(self):
+        limit = self.executed[-1][1][-1]
+        return self.rows[:limit]
+
+
+@pytest.fixture
+def db(monkeypatch):
+    cursor = FakeCursor([])
+
+    class Conn:
+        def cursor(self):
+            return cursor
+
+    @contextmanager
+    def fake_get_conn():
+        yield Conn()
+
+    monkeypatch.setattr(models, "get_conn", fake_get_conn)
+    return cursor
+
+
+def _rows(n):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return [{"id": n - i, "created_at": start - timedelta(minutes=i)} for i in range(n)]
+
+
+def test_cursor_round_trip():
+    created_at = datetime(2024, 5, 17, 9, 30, 15, 123456, tzinfo=timezone.utc)
+    assert decode_cursor(encode_cursor(created_at, 42)) == (created_at, 42)
+
+
+def test_cursor_is_url_safe():
+    cursor = encode_cursor(datetime(2024, 5, 17, tzinfo=timezone.utc), 10 ** 12)
+    assert all(c.isalnum() or c in "-_=" for c in cursor)
+
+
+@pytest.mark.parametrize("cursor", [
+    "",
+    "not base64!",
+    base64.urlsafe_b64encode(b"not json").decode(),
+    base64.urlsafe_b64encode(b'{"a": 1}').decode(),
+    base64.urlsafe_b64encode(b'["2024-01-01T00:00:00"]').decode(),
+    base64.urlsafe_b64encode(b'["yesterday", 1]').decode(),
+    base64.urlsafe_b64encode(b'["2024-01-01T00:00:00", "x"]').decode(),
+])
+def test_malformed_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+def test_keyset_page_returns_next_cursor_from_last_row(db):
+    db.rows = _rows(5)
+    rows, next_cursor = models._keyset_page("chats", "id, created_at", [("user_id = %s", 7)], 2, None)
+
+    assert [r["id"] for r in rows] == [5, 4]
+    assert decode_cursor(next_cursor) == (rows[-1]["created_at"], 4)
+    sql, params = db.executed[-1]
+    assert "(created_at, id) <" not in sql
+    assert params == [7, 3]
+
+
+def test_keyset_page_applies_cursor(db):
+    db.rows = _rows(2)
+    created_at = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    rows, next_cursor = models._keyset_page(
+        "chats", "id, created_at", [("user_id = %s", 7)], 2, encode_cursor(created_at, 9)
+    )
+
+    assert next_cursor is None
+    sql, params = db.executed[-1]
+    assert "(created_at, id) < (%s, %s)" in sql
+    assert params == [7, created_at, 9, 3]
+
+
+def test_keyset_page_rejects_bad_cursor_before_querying(db):
+    with pytest.raises(ValueError):
+        models._keyset_page("chats", "id, created_at", [("user_id = %s", 7)], 2, "garbage")
+    assert db.executed == []
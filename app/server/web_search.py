@@ -1,6 +1,67 @@
 import os
+import time
+import threading
 import requests
 import json
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+
+SERPER_URL = os.getenv("SERPER_URL", "https://google.serper.dev/search")
+SERPER_CONNECT_TIMEOUT = float(os.getenv("SERPER_CONNECT_TIMEOUT", "2"))
+SERPER_READ_TIMEOUT = float(os.getenv("SERPER_READ_TIMEOUT", "5"))
+WEB_CACHE_TTL = float(os.getenv("WEB_CACHE_TTL", "900"))
+WEB_CACHE_MAX_ENTRIES = int(os.getenv("WEB_CACHE_MAX_ENTRIES", "2048"))
+
+# One keep-alive connection pool per process instead of a handshake per call
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=1))
+_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=1))
+
+class SearchCache:
+    """TTL + LRU cache of search results keyed by (normalized query, top_k)."""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] < time.monotonic():
+                del self._data[key]
+                self.expired += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return [dict(r) for r in item[1]]
+
+    def put(self, key, results):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, [dict(r) for r in results])
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+search_cache = SearchCache(WEB_CACHE_TTL, WEB_CACHE_MAX_ENTRIES)
 
 def web_search(query: str, top_k: int = 3):
     print(f"DEBUG: Serper Searching for: '{query}'")
@@ -10,7 +71,12 @@ def web_search(query: str, top_k: int = 3):
         print("DEBUG: SERPER_API_KEY not found in .env")
         return []
 
-    url = "https://google.serper.dev/search"
+    cache_key = (" ".join(query.lower().split()), top_k)
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        print(f"DEBUG: Serper cache hit ({len(cached)} results).")
+        return cached
+
     payload = json.dumps({
         "q": query,
         "num": top_k
@@ -21,7 +87,11 @@ def web_search(query: str, top_k: int = 3):
     }
 
     try:
-        response = requests.request("POST", url, headers=headers, data=payload)
+        response = _session.post(
+            SERPER_URL, headers=headers, data=payload,
+            timeout=(SERPER_CONNECT_TIMEOUT, SERPER_READ_TIMEOUT)
+        )
+        response.raise_for_status()
         data = response.json()
         
         out = []
@@ -35,8 +105,9 @@ def web_search(query: str, top_k: int = 3):
                 })
                 
         print(f"DEBUG: Found {len(out)} Serper results.")
+        search_cache.put(cache_key, out)
         return out
 
     except Exception as e:
         print(f"DEBUG: Serper API Failed: {e}")
-        return []
\ No newline at end of file
+        return []
@@ -50,8 +50,8 @@ export default function ChatArea({ selectedDocument, onPageClick }: ChatAreaProp
         setIsLoading(true);
         setMessages([]); 
         try {
-            const chatsRes = await api.get('/chats');
-            const existingChat = chatsRes.data.chats.find((c: any) => c.name === selectedDocument);
+            const chatsRes = await api.get('/chats', { params: { name: selectedDocument, limit: 1 } });
+            const existingChat = chatsRes.data.chats[0];
 
             if (existingChat) {
                 setChatId(existingChat.id);
@@ -65,8 +65,8 @@ export default function ChatArea({ selectedDocument, onPageClick }: ChatAreaProp
                     setMessages(history.length ? history : [{ id: 'welcome', role: 'assistant', content: `Welcome back! Ask me anything about ${selectedDocument}.` }]);
                 }
             } else {
-                const colsRes = await api.get('/collections');
-                const col = colsRes.data.collections.find((c: any) => c.filename === selectedDocument);
+                const colsRes = await api.get('/collections', { params: { filename: selectedDocument, limit: 1 } });
+                const col = colsRes.data.collections[0];
                 if (col) {
                     const createRes = await api.post('/chats', { name: selectedDocument, collection_id: col.id });
                     if (createRes.data.ok) {
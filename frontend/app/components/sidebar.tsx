@@ -25,6 +25,8 @@ export default function Sidebar({ open, onOpenChange, onSelectDocument }: Sideba
   const [showUploadZone, setShowUploadZone] = useState(false)
   const [documents, setDocuments] = useState<any[]>([])
   const [chats, setChats] = useState<any[]>([])
+  const [docsCursor, setDocsCursor] = useState<string | null>(null)
+  const [chatsCursor, setChatsCursor] = useState<string | null>(null)
   const [isLoading, setIsLoading] = useState(true)
 
   const loadData = useCallback(async () => {
@@ -35,8 +37,14 @@ export default function Sidebar({ open, onOpenChange, onSelectDocument }: Sideba
         api.get('/chats')
       ])
       
-      if (docsRes.data.ok) setDocuments(docsRes.data.collections)
-      if (chatsRes.data.ok) setChats(chatsRes.data.chats)
+      if (docsRes.data.ok) {
+        setDocuments(docsRes.data.collections)
+        setDocsCursor(docsRes.data.next_cursor)
+      }
+      if (chatsRes.data.ok) {
+        setChats(chatsRes.data.chats)
+        setChatsCursor(chatsRes.data.next_cursor)
+      }
       
     } catch (e) {
       console.error("Sidebar Load Error", e)
@@ -45,6 +53,28 @@ export default function Sidebar({ open, onOpenChange, onSelectDocument }: Sideba
     }
   }, [])
 
+  const loadMoreDocs = async () => {
+    if (!docsCursor) return
+    try {
+      const res = await fetchCollections(docsCursor)
+      if (res.data.ok) {
+        setDocuments(prev => [...prev, ...res.data.collections])
+        setDocsCursor(res.data.next_cursor)
+      }
+    } catch (e) { console.error(e) }
+  }
+
+  const loadMoreChats = async () => {
+    if (!chatsCursor) return
+    try {
+      const res = await api.get('/chats', { params: { cursor: chatsCursor } })
+      if (res.data.ok) {
+        setChats(prev => [...prev, ...res.data.chats])
+        setChatsCursor(res.data.next_cursor)
+      }
+    } catch (e) { console.error(e) }
+  }
+
   useEffect(() => {
     loadData();
   }, [loadData]);
@@ -162,6 +192,11 @@ export default function Sidebar({ open, onOpenChange, onSelectDocument }: Sideba
                     </div>
                   ))
                 )}
+                {!isLoading && docsCursor && (
+                  <button onClick={loadMoreDocs} className="text-xs text-muted-foreground hover:text-foreground px-3 py-1">
+                    Load more
+                  </button>
+                )}
               </div>
             )}
           </div>
@@ -199,6 +234,11 @@ export default function Sidebar({ open, onOpenChange, onSelectDocument }: Sideba
                       </div>
                     ))
                  )}
+                 {chatsCursor && (
+                    <button onClick={loadMoreChats} className="text-xs text-muted-foreground hover:text-foreground px-3 py-1">
+                      Load more
+                    </button>
+                 )}
               </div>
             )}
           </div>
@@ -12,8 +12,8 @@ export async function getMe() {
   return api.get("/me");
 }
 
-export function fetchCollections() {
-  return api.get("/collections");
+export function fetchCollections(cursor?: string | null) {
+  return api.get("/collections", { params: cursor ? { cursor } : {} });
 }
 
 export function uploadPDF(file: File) {